@@ -0,0 +1,388 @@
+"""
+Rough benchmarks for a node's hot paths.
+Run from src/ as `python benchmark.py`, the chains it builds are written to a temporary directory.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from multiprocessing import RawValue
+from typing import Optional
+
+import core
+import utils.constants as consts
+import utils.storage as storage
+from core import Block, BlockChain, BlockHeader, Chain, SingleOutput, Transaction, TxIn, TxOut, Utxo, genesis_block
+from mempool import Mempool
+from miner import Miner, WorkUnit, search_nonces
+from utils.merkle import MerkleTree
+from utils.storage import read_header_list_from_db
+from utils.utils import dhash, merkle_hash
+from verifier import verify_batch, verify_serial
+from wallet import Wallet
+
+# The benchmarks build throwaway chains, they must never touch the node's own DB files
+DB_DIR = tempfile.mkdtemp(prefix="somechain-bench-")
+atexit.register(shutil.rmtree, DB_DIR, ignore_errors=True)
+for name in ("BLOCK_DB_LOC", "CHAIN_DB_LOC", "CHAINSTATE_DB_LOC"):
+    loc = os.path.join(DB_DIR, os.path.basename(getattr(consts, name)))
+    setattr(consts, name, loc)
+    setattr(storage, name, loc)
+
+
+# Unslotted copies of the classes as they were before __slots__, the baseline for bench_memory
+
+
+@dataclass
+class PlainSingleOutput:
+    txid: str
+    vout: int
+
+
+@dataclass
+class PlainTxOut(dict):
+    amount: int
+    address: str
+
+
+@dataclass
+class PlainTxIn(dict):
+    payout: Optional[PlainSingleOutput]
+    sig: str
+    pub_key: str
+
+
+@dataclass
+class PlainBlockHeader:
+    version: int
+    height: Optional[int]
+    prev_block_hash: Optional[str]
+    merkle_root: str
+    timestamp: int
+    target_difficulty: int
+    nonce: int
+
+
+def allocated_per_object(build, n: int) -> float:
+    """Bytes allocated per object by build(n), which must return everything it built"""
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    objs = build(n)
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del objs
+    return used / n
+
+
+def build_txouts(n: int, txout_cls=TxOut):
+    return [txout_cls(amount=i, address=consts.WALLET_PUBLIC) for i in range(n)]
+
+
+def build_txins(n: int, txin_cls=TxIn, so_cls=SingleOutput):
+    return [txin_cls(payout=so_cls(txid=dhash(str(i)), vout=i % 2), sig=str(i), pub_key=consts.WALLET_PUBLIC) for i in range(n)]
+
+
+def build_header_list(n: int, header_cls=BlockHeader):
+    headers = []
+    for i in range(n):
+        header = header_cls(
+            version=consts.MINER_VERSION,
+            height=i,
+            prev_block_hash=dhash(str(i)),
+            merkle_root=dhash(str(-i)),
+            timestamp=1535646190 + i,
+            target_difficulty=consts.INITIAL_BLOCK_DIFFICULTY,
+            nonce=i,
+        )
+        if header_cls is BlockHeader:
+            header.hash
+        else:
+            # Where the hash was cached before the header had slots
+            header._hash = dhash(str(header))
+        headers.append(header)
+    return headers
+
+
+def build_utxo(n: int, addresses: int = 100):
+    utxo = Utxo()
+    for i in range(n):
+        so = SingleOutput(txid=dhash(str(i // 2)), vout=i % 2)
+        utxo.set(so, TxOut(amount=i, address=dhash(str(i % addresses))), i // 4, False)
+    utxo.changes.clear()
+    return utxo
+
+
+def bench_memory(n: int = 100_000):
+    """Bytes per object of the slotted classes against unslotted copies of them"""
+    print(f"Memory, {n} objects each, bytes/object")
+    print("                      unslotted   slotted")
+    builds = (
+        ("TxOut", lambda n: build_txouts(n, PlainTxOut), build_txouts),
+        ("TxIn", lambda n: build_txins(n, PlainTxIn, PlainSingleOutput), build_txins),
+        ("header_list entry", lambda n: build_header_list(n, PlainBlockHeader), build_header_list),
+    )
+    for name, plain, slotted in builds:
+        print(f"  {name:18s} {allocated_per_object(plain, n):10.1f} {allocated_per_object(slotted, n):9.1f}")
+    print(f"  Utxo entry         {'':10s} {allocated_per_object(build_utxo, n):9.1f}")
+
+
+def bench_utxo_lookups(n: int = 100_000, lookups: int = 1000):
+    utxo = build_utxo(n)
+    so = SingleOutput(txid=dhash(str(n // 4)), vout=1)
+    tss = time.time()
+    for _ in range(lookups):
+        utxo.get(so)
+    get_time = (time.time() - tss) / lookups
+    tss = time.time()
+    for _ in range(lookups // 100):
+        utxo.balance(dhash(str(0)))
+    balance_time = (time.time() - tss) / (lookups // 100)
+    print(f"UTXO set of {n} outputs over 100 addresses")
+    print(f"  get:     {get_time * 1e6:8.2f} us")
+    print(f"  balance: {balance_time * 1e3:8.2f} ms")
+
+
+def next_block(chain: Chain, spend: list, timestamp: int, w: Wallet) -> Block:
+    coinbase = Transaction(
+        is_coinbase=True,
+        version=consts.MINER_VERSION,
+        fees=0,
+        timestamp=timestamp,
+        locktime=-1,
+        vin={0: TxIn(payout=None, sig="Receiving some Money", pub_key="Does it matter?")},
+        vout={
+            0: TxOut(amount=chain.current_block_reward(), address=w.public_key),
+            1: TxOut(amount=sum(tx.fees for tx in spend), address=w.public_key),
+        },
+    )
+    transactions = [coinbase] + spend
+    header = BlockHeader(
+        version=consts.MINER_VERSION,
+        height=chain.length,
+        prev_block_hash=chain.header_list[-1].hash,
+        merkle_root=merkle_hash(transactions),
+        timestamp=timestamp,
+        target_difficulty=chain.target_difficulty,
+        nonce=0,
+    )
+    return Block(header=header, transactions=transactions)
+
+
+def build_chain(length: int, w: Wallet) -> BlockChain:
+    """Builds a chain where every block spends the coinbase of the block before it"""
+    blockchain = BlockChain()
+    blockchain.add_block(genesis_block)
+    timestamp = int(time.time()) - length * consts.AVERAGE_BLOCK_MINE_INTERVAL
+    spend = []
+    for _ in range(length):
+        chain = blockchain.active_chain
+        timestamp += consts.AVERAGE_BLOCK_MINE_INTERVAL
+        block = next_block(chain, spend, timestamp, w)
+        blockchain.add_block(block)
+        coinbase = block.transactions[0]
+        tx = Transaction(
+            is_coinbase=False,
+            version=consts.MINER_VERSION,
+            fees=1,
+            timestamp=timestamp,
+            locktime=0,
+            vin={0: TxIn(payout=SingleOutput(txid=coinbase.hash, vout=0), sig="", pub_key=w.public_key)},
+            vout={0: TxOut(amount=coinbase.vout[0].amount - 1, address=w.public_key)},
+        )
+        tx.sign(w)
+        spend = [tx]
+    return blockchain
+
+
+def throwaway_wallet() -> Wallet:
+    # Keep the throwaway wallet out of the wallet directory
+    w = Wallet.__new__(Wallet)
+    w.private_key, w.public_key = w.generate_address()
+    return w
+
+
+def remove_db_files():
+    for loc in (consts.BLOCK_DB_LOC, consts.CHAIN_DB_LOC, consts.CHAINSTATE_DB_LOC):
+        if os.path.exists(loc):
+            os.remove(loc)
+
+
+def bench_restore(lengths=(100, 200, 400)):
+    """Restart time when replaying every block vs loading the chainstate DB"""
+    # The synthetic chains are not mined
+    meets_target_difficulty = core.meets_target_difficulty
+    core.meets_target_difficulty = lambda bhash, target_difficulty: True
+    w = throwaway_wallet()
+    print("Restore, replaying blocks vs loading chainstate")
+    try:
+        for length in lengths:
+            remove_db_files()
+            build_chain(length, w)
+
+            tss = time.time()
+            replayed = BlockChain()
+            replayed.build_from_header_list(read_header_list_from_db())
+            replay_time = time.time() - tss
+
+            tss = time.time()
+            restored = BlockChain()
+            restored.restore_from_chainstate()
+            restore_time = time.time() - tss
+
+            assert restored.active_chain.length == replayed.active_chain.length == length + 1
+            print(f"  {length:6d} blocks: replay {replay_time:7.2f} secs, chainstate {restore_time:7.3f} secs")
+    finally:
+        core.meets_target_difficulty = meets_target_difficulty
+        remove_db_files()
+
+
+def bench_reorg(lengths=(100, 200, 400), depth: int = 2):
+    """Time to add a branch that forks off depth blocks below the tip and takes over, for growing chains"""
+    meets_target_difficulty = core.meets_target_difficulty
+    core.meets_target_difficulty = lambda bhash, target_difficulty: True
+    w = throwaway_wallet()
+    print(f"Reorg {depth} blocks deep")
+    try:
+        for length in lengths:
+            remove_db_files()
+            blockchain = build_chain(length, w)
+            tip = blockchain.active_chain.header_list[-1]
+            # Build the competing branch on a copy of the chain below the fork point
+            side = Chain.build_from_header_list(blockchain.active_chain.header_list[: length + 1 - depth])
+            branch = []
+            for i in range(depth + 1):
+                block = next_block(side, [], tip.timestamp + i + 1, w)
+                side.connect_block(block)
+                branch.append(block)
+            tss = time.time()
+            for block in branch:
+                assert blockchain.add_block(block)
+            assert blockchain.active_chain.header_list[-1].hash == branch[-1].header.hash
+            print(f"  {length:6d} blocks: {(time.time() - tss) * 1e3:8.2f} ms")
+    finally:
+        core.meets_target_difficulty = meets_target_difficulty
+        remove_db_files()
+
+
+def bench_signatures(n: int = 1000):
+    """Verifying n input signatures serially vs across VERIFY_WORKERS processes"""
+    w = throwaway_wallet()
+    checks = []
+    for i in range(n):
+        message = dhash(str(i))
+        checks.append((message, w.sign(message), w.public_key))
+    print(f"Verify {n} signatures")
+    tss = time.time()
+    assert verify_serial(checks)
+    print(f"  serial:      {time.time() - tss:6.2f} secs")
+    # The first batch pays for starting the pool
+    verify_batch([(message, w.sign(message), w.public_key) for message in ("warm up",) * consts.PARALLEL_VERIFY_MIN_SIGNATURES])
+    tss = time.time()
+    assert verify_batch(checks)
+    print(f"  {consts.VERIFY_WORKERS:2d} workers:  {time.time() - tss:6.2f} secs")
+    tss = time.time()
+    assert verify_batch(checks)
+    print(f"  cached:      {time.time() - tss:6.2f} secs")
+
+
+def build_pool_transactions(n: int):
+    """Unsigned transactions each spending its own output, the mempool does not check signatures"""
+    return [
+        Transaction(
+            is_coinbase=False,
+            version=consts.MINER_VERSION,
+            fees=1 + i % 97,
+            timestamp=1535646190 + i,
+            locktime=0,
+            vin={0: TxIn(payout=SingleOutput(txid=dhash(str(i)), vout=0), sig="", pub_key=consts.WALLET_PUBLIC)},
+            vout={0: TxOut(amount=100, address=consts.WALLET_PUBLIC)},
+        )
+        for i in range(n)
+    ]
+
+
+def bench_mempool(n: int = 20_000, block_size: int = 1000):
+    """Filling the mempool, reading it by fee rate and removing a block's transactions"""
+    transactions = build_pool_transactions(n)
+    for tx in transactions:
+        tx.hash, tx.size
+    mempool = Mempool()
+    print(f"Mempool of {n} transactions")
+    tss = time.time()
+    for tx in transactions:
+        mempool.add(tx)
+    print(f"  add:           {(time.time() - tss) / n * 1e6:8.2f} us/tx")
+    tss = time.time()
+    mempool.best_transactions(block_size)
+    print(f"  best {block_size}:     {(time.time() - tss) * 1e3:8.2f} ms")
+    max_size = consts.MAX_BLOCK_SIZE_KB * 1024
+    tss = time.time()
+    mempool.block_template(max_size)
+    print(f"  template:      {(time.time() - tss) * 1e3:8.2f} ms")
+    block = Block(header=genesis_block.header, transactions=mempool.best_transactions(block_size))
+    tss = time.time()
+    assert mempool.remove_block_transactions(block) == block_size
+    print(f"  remove block:  {(time.time() - tss) * 1e3:8.2f} ms for {block_size} transactions")
+    tss = time.time()
+    template = mempool.block_template(max_size)[0]
+    print(f"  new template:  {(time.time() - tss) * 1e3:8.2f} ms")
+    tss = time.time()
+    mempool.remove(template[-1].hash)
+    mempool.block_template(max_size)
+    print(f"  drop last tx:  {(time.time() - tss) * 1e3:8.2f} ms")
+    tss = time.time()
+    MerkleTree.from_transactions(template)
+    print(f"  full merkle:   {(time.time() - tss) * 1e3:8.2f} ms for the {len(template)} transactions of the template")
+
+
+def bench_mining(n: int = 200_000):
+    """Hashes per second on one core, hashing the whole header per nonce vs from the midstate"""
+    header = build_header_list(1)[0]
+    tss = time.time()
+    for nonce in range(n // 10):
+        header.nonce = nonce
+        core.meets_target_difficulty(header.hash, consts.INITIAL_BLOCK_DIFFICULTY)
+    full_rate = n // 10 / (time.time() - tss)
+
+    # A zero target is never met so all n nonces are tried
+    current_job = RawValue("q", 1)
+    tss = time.time()
+    search_nonces(WorkUnit(job_id=1, prefix=header.hash_prefix(), target=0, start=0, end=n), current_job)
+    midstate_rate = n / (time.time() - tss)
+    print("Mining hash rate on one core")
+    print(f"  full header: {full_rate / 1e3:8.1f} kH/s")
+    print(f"  midstate:    {midstate_rate / 1e3:8.1f} kH/s")
+
+
+def bench_mining_restart(rounds: int = 100):
+    """Time to hand the workers a new block template, it no longer depends on the chain or mempool size"""
+    chain = Chain()
+    chain.connect_block(genesis_block)
+    # Never met, the workers keep searching until preempted
+    chain.target_difficulty = 2 ** 256
+    miner = Miner(workers=1)
+    mempool = Mempool()
+    miner.start_mining(mempool, chain, consts.WALLET_PUBLIC)
+    miner.stop_mining()
+    tss = time.time()
+    for _ in range(rounds):
+        miner.start_mining(mempool, chain, consts.WALLET_PUBLIC)
+        miner.stop_mining()
+    print(f"Mining restart: {(time.time() - tss) / rounds * 1e3:8.2f} ms")
+
+
+if __name__ == "__main__":
+    tss = time.time()
+    bench_memory()
+    bench_utxo_lookups()
+    bench_restore()
+    bench_reorg()
+    bench_signatures()
+    bench_mempool()
+    bench_mining()
+    bench_mining_restart()
+    print(f"Done in {time.time() - tss:.1f} secs")
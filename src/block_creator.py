@@ -11,7 +11,7 @@ from core import (Block, BlockHeader, Chain, SingleOutput, Transaction, TxIn,
 from utils import constants as consts
 from utils.logger import logger
 from utils.storage import get_block_from_db
-from utils.utils import dhash, merkle_hash
+from utils.utils import merkle_hash
 
 app = Flask(__name__)
 
@@ -72,15 +72,13 @@ def getblock():
 @app.route("/getblockhashes", methods=["POST"])
 def send_block_hashes():
     peer_height = int(request.form.get("myheight"))
-    hash_list = []
-    for i in range(peer_height, ACTIVE_CHAIN.length):
-        hash_list.append(dhash(ACTIVE_CHAIN.header_list[i]))
+    hash_list = ACTIVE_CHAIN.hash_list[peer_height:]
     logger.debug(peer_height)
     return jsonify(hash_list)
 
 
 # The singleOutput for first coinbase transaction in genesis block
-so = SingleOutput(txid=dhash(genesis_block_transaction[0]), vout=0)
+so = SingleOutput(txid=genesis_block_transaction[0].hash, vout=0)
 
 first_block_transactions = [
     Transaction(
@@ -112,7 +110,7 @@ for tx in first_block_transactions:
 
 first_block_header = BlockHeader(
     version=1,
-    prev_block_hash=dhash(genesis_block_header),
+    prev_block_hash=genesis_block_header.hash,
     height=1,
     merkle_root=merkle_hash(first_block_transactions),
     timestamp=1231006505,
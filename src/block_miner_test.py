@@ -1,7 +1,6 @@
 import time
 
 from core import genesis_block, genesis_block_header
-from utils.utils import dhash
 
 
 def is_proper_difficulty(target_difficulty, bhash: str) -> bool:
@@ -16,14 +15,14 @@ def is_proper_difficulty(target_difficulty, bhash: str) -> bool:
     return True
 
 
-print(genesis_block, dhash(genesis_block_header))
+print(genesis_block, genesis_block_header.hash)
 
 for difficulty in range(5, 10):
     tss = time.time()
     for n in range(2 ** 64):
         genesis_block_header.nonce = n
         genesis_block_header.target_difficulty = difficulty
-        bhash = dhash(genesis_block_header)
+        bhash = genesis_block_header.hash
         if is_proper_difficulty(difficulty, bhash):
             print(f"Timestamp {int(tss)} Nonce {n} hash {bhash}\n Difficulty {difficulty} in {(time.time() - tss)} secs")
             print(genesis_block_header)
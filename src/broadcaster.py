@@ -0,0 +1,313 @@
+import json
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from typing import Any, Callable, Deque, Dict, Hashable, Iterable, List, Optional, Tuple, Union
+
+import utils.constants as consts
+from peer_client import PEER_CLIENT, PeerClient
+from utils.logger import logger
+
+Payload = Union[bytes, str]
+
+# Kinds of inventory
+INV_BLOCK = "block"
+INV_TX = "tx"
+
+# (kind, hash) of a block or transaction
+InvItem = Tuple[str, str]
+
+# Returns the path to post an item to and its payload, None if we no longer have it
+PayloadSource = Callable[[str, str], Optional[Tuple[str, Payload]]]
+
+
+class RecentSet:
+    """ Set that forgets its oldest entries past maxsize """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Hashable, None]" = OrderedDict()
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, item: Hashable):
+        self.entries[item] = None
+        self.entries.move_to_end(item)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class PeerQueue:
+    """ Inventory waiting to be announced to one peer, oldest first, and what the peer is known to have """
+
+    def __init__(self, base_url: str, maxsize: int):
+        self.base_url = base_url
+        self.maxsize = maxsize
+        self.items: "OrderedDict[InvItem, None]" = OrderedDict()
+        self.known = RecentSet(consts.KNOWN_INVENTORY_SIZE)
+        # Whether a pool thread is draining the queue
+        self.draining = False
+        self.announced = 0
+        self.sent = 0
+        self.failed = 0
+        self.skipped_known = 0
+        self.dropped = 0
+
+    def requeue(self, items: List[InvItem]):
+        """Puts items that could not be delivered back at the front, they go out with the next drain"""
+        for item in reversed(items):
+            if item in self.items or item in self.known:
+                continue
+            if len(self.items) >= self.maxsize:
+                self.dropped += 1
+                continue
+            self.items[item] = None
+            self.items.move_to_end(item, last=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self.items),
+            "known": len(self.known),
+            "announced": self.announced,
+            "sent": self.sent,
+            "failed": self.failed,
+            "skipped_known": self.skipped_known,
+            "dropped": self.dropped,
+        }
+
+
+class InvRequest:
+    """ An item we asked a peer for, and the other peers that announced it """
+
+    __slots__ = ("peer", "asked_at", "announcers")
+
+    def __init__(self, peer: Optional[str]):
+        self.peer = peer
+        self.asked_at = time.time()
+        self.announcers: Deque[str] = deque(maxlen=consts.MAX_INV_ANNOUNCERS)
+
+
+class Broadcaster:
+    """Gossips blocks and transactions to peers by inventory, from a fixed pool of threads
+
+    Only hashes are announced, on /inv, and the peer answers with the ones it is missing, which are
+    then posted in full. An item counts as known to a peer once it did not want it or was sent it, and
+    is never announced to it again, per peer known sets remember the last KNOWN_INVENTORY_SIZE items.
+
+    An item we want is asked of the first peer announcing it. If it has not arrived INV_REQUEST_TIMEOUT_SECS
+    later, it is fetched on /getdata from the next peer that announced it.
+
+    Each peer has its own bounded queue, drained by at most one pool thread at a time, so a slow peer
+    only holds up its own announcements. A peer that falls BROADCAST_QUEUE_SIZE items behind has its
+    oldest ones dropped. Items that could not be delivered stay queued until the next announcement.
+    """
+
+    def __init__(
+        self,
+        payload_for: PayloadSource,
+        have: Callable[[str, str], bool],
+        deliver: Callable[[str, Payload], Any],
+        client: PeerClient = PEER_CLIENT,
+        workers: int = consts.BROADCAST_WORKERS,
+        queue_size: int = consts.BROADCAST_QUEUE_SIZE,
+        timeout=consts.BROADCAST_TIMEOUT,
+    ):
+        self.payload_for = payload_for
+        self.have = have
+        self.deliver = deliver
+        self.client = client
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Broadcast")
+        # Mapping from peer base url to its queue
+        self.queues: Dict[str, PeerQueue] = {}
+        # Items asked for and not yet seen to arrive, oldest first
+        self.requests: "OrderedDict[InvItem, InvRequest]" = OrderedDict()
+        self.refetched = 0
+        self.given_up = 0
+        self.retry_thread: Optional[Thread] = None
+        self.lock = Lock()
+
+    def announce(self, base_urls: Iterable[str], kind: str, item_hash: str):
+        """Queues an item to be announced to every peer that does not have it and returns right away"""
+        item = (kind, item_hash)
+        with self.lock:
+            for base_url in base_urls:
+                queue = self.queues.get(base_url)
+                if queue is None:
+                    queue = self.queues[base_url] = PeerQueue(base_url, self.queue_size)
+                if item in queue.known or item in queue.items:
+                    queue.skipped_known += 1
+                    continue
+                if len(queue.items) >= queue.maxsize:
+                    queue.items.popitem(last=False)
+                    queue.dropped += 1
+                    logger.debug(f"Broadcaster: {base_url} is falling behind, dropped its oldest announcement")
+                queue.items[item] = None
+                if not queue.draining:
+                    queue.draining = True
+                    self.pool.submit(self.drain, queue)
+
+    def mark_known(self, base_url: str, kind: str, hashes: Iterable[str]):
+        """Records that a peer we announce to has these items, it announced or sent them to us"""
+        with self.lock:
+            queue = self.queues.get(base_url)
+            if queue is None:
+                return
+            for item_hash in hashes:
+                queue.known.add((kind, item_hash))
+
+    def wanted(self, kind: str, hashes: List[str], announcer: Optional[str]) -> List[str]:
+        """Returns the announced hashes we do not have and have not asked another peer for
+
+        The announcer is remembered for the rest, to fetch them from if the peer asked does not deliver.
+        It is None for a client we do not know, which can send what it announced but is never fetched from.
+        """
+        want = []
+        with self.lock:
+            if self.retry_thread is None:
+                self.retry_thread = Thread(target=self.retry_requests_task, name="InvRequests", daemon=True)
+                self.retry_thread.start()
+            for item_hash in hashes:
+                item = (kind, item_hash)
+                request = self.requests.get(item)
+                overdue = request is not None and time.time() - request.asked_at >= consts.INV_REQUEST_TIMEOUT_SECS
+                if request is not None and not overdue:
+                    if announcer is not None and announcer != request.peer and announcer not in request.announcers:
+                        request.announcers.append(announcer)
+                    continue
+                if self.have(kind, item_hash):
+                    continue
+                if overdue:
+                    # Asked of this announcer instead, the peer asked before did not deliver
+                    request.peer = announcer
+                    request.asked_at = time.time()
+                    self.refetched += 1
+                else:
+                    self.requests[item] = InvRequest(announcer)
+                if len(self.requests) > consts.KNOWN_INVENTORY_SIZE:
+                    self.requests.popitem(last=False)
+                want.append(item_hash)
+        return want
+
+    def retry_requests_task(self):
+        while True:
+            time.sleep(consts.INV_REQUEST_TIMEOUT_SECS / 2)
+            try:
+                self.retry_requests()
+            except Exception as e:
+                logger.error("Broadcaster: Error while retrying requests " + str(e))
+
+    def retry_requests(self):
+        """Forgets the requested items that arrived, and fetches those overdue from the next peer that announced them"""
+        now = time.time()
+        fetches = []
+        with self.lock:
+            for item, request in list(self.requests.items()):
+                if self.have(*item):
+                    del self.requests[item]
+                    continue
+                if now - request.asked_at < consts.INV_REQUEST_TIMEOUT_SECS:
+                    continue
+                if not request.announcers:
+                    logger.debug(f"Broadcaster: No peer delivered {item[0]} {item[1]}, giving up on it")
+                    del self.requests[item]
+                    self.given_up += 1
+                    continue
+                request.peer = request.announcers.popleft()
+                request.asked_at = now
+                self.refetched += 1
+                fetches.append((request.peer, item))
+        for base_url, (kind, item_hash) in fetches:
+            self.pool.submit(self.fetch, base_url, kind, item_hash)
+
+    def fetch(self, base_url: str, kind: str, item_hash: str):
+        """Asks a peer for an item on /getdata and hands it to deliver"""
+        try:
+            r = self.client.post(base_url, "/getdata", data={"type": kind, "hash": item_hash}, timeout=self.timeout, retries=0)
+            if r.content:
+                self.deliver(kind, r.content)
+        except Exception as e:
+            logger.debug(f"Broadcaster: Could not fetch {kind} {item_hash} from {base_url} " + str(e))
+
+    def drain(self, queue: PeerQueue):
+        while True:
+            with self.lock:
+                if not queue.items:
+                    queue.draining = False
+                    return
+                # Announced a batch per kind, in the order the kinds were queued
+                batch: Dict[str, List[str]] = OrderedDict()
+                for _ in range(min(len(queue.items), consts.INV_BATCH_SIZE)):
+                    kind, item_hash = queue.items.popitem(last=False)[0]
+                    batch.setdefault(kind, []).append(item_hash)
+            undelivered = []
+            for kind, hashes in batch.items():
+                if undelivered:
+                    undelivered.extend((kind, item_hash) for item_hash in hashes)
+                else:
+                    undelivered.extend(self.send_inventory(queue, kind, hashes))
+            if undelivered:
+                # The peer is not taking them now, they are tried again once there is something new for it
+                with self.lock:
+                    queue.requeue(undelivered)
+                    queue.draining = False
+                return
+
+    def send_inventory(self, queue: PeerQueue, kind: str, hashes: List[str]) -> List[InvItem]:
+        """Announces hashes to the peer and posts the items it asks for
+
+        Returns:
+            List[InvItem] -- The items that did not reach the peer, nothing after the first failure is sent
+        """
+        try:
+            r = self.client.post(
+                queue.base_url,
+                "/inv",
+                data={"type": kind, "hashes": json.dumps(hashes), "port": consts.MINER_SERVER_PORT},
+                timeout=self.timeout,
+                retries=0,
+            )
+            want = set(json.loads(r.text)) & set(hashes)
+        except Exception:
+            logger.debug("Server: Requests: Error while announcing to " + queue.base_url)
+            with self.lock:
+                queue.failed += 1
+            return [(kind, item_hash) for item_hash in hashes]
+        with self.lock:
+            queue.announced += len(hashes)
+            for item_hash in hashes:
+                if item_hash not in want:
+                    queue.known.add((kind, item_hash))
+        for i, item_hash in enumerate(hashes):
+            if item_hash not in want:
+                continue
+            item = self.payload_for(kind, item_hash)
+            if item is None:
+                continue
+            path, payload = item
+            try:
+                self.client.post(queue.base_url, path, data=payload, timeout=self.timeout, retries=0)
+            except Exception:
+                logger.debug("Server: Requests: Error while sending data to " + queue.base_url)
+                with self.lock:
+                    queue.failed += 1
+                return [(kind, h) for h in hashes[i:] if h in want]
+            with self.lock:
+                queue.sent += 1
+                queue.known.add((kind, item_hash))
+        return []
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "peers": {base_url: queue.to_dict() for base_url, queue in self.queues.items()},
+                "requests": len(self.requests),
+                "refetched": self.refetched,
+                "given_up": self.given_up,
+            }
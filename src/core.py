@@ -1,47 +1,111 @@
-import copy
 import json
-from collections import Counter
+import time
 from dataclasses import dataclass, field
-from operator import attrgetter
+from enum import IntEnum
+from functools import lru_cache
+from math import ceil
 from statistics import median
-from sys import getsizeof
+from sys import getsizeof, intern
 from threading import RLock
-from typing import Any, Dict, List, Optional, Set
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 import utils.constants as consts
-from utils.dataclass_json import DataClassJson
+from mempool import Mempool
+from utils.codec import DataClassBinary, Reader, Writer, unpack_frame
+from utils.dataclass_json import DataClassJson, add_slots
 from utils.logger import logger
-from utils.storage import add_block_to_db, check_block_in_db, get_block_from_db, remove_block_from_db, write_header_list_to_db
+from utils.merkle import MerkleTree
+from utils.storage import (
+    add_block_to_db,
+    check_block_in_db,
+    get_block_from_db,
+    read_chainstate,
+    remove_block_from_db,
+    write_chainstate,
+    write_header_list_to_db,
+)
 from utils.utils import dhash, get_time_difference_from_now_secs, lock, merkle_hash
+from verifier import SigCheck, verify_batch, verify_one
 from wallet import Wallet
 
 
+class CachedHash:
+    """ Memoizes the canonical dhash of an object until one of its fields is set again """
+
+    __slots__ = ()
+
+    # Attributes derived from the fields, dropped whenever a field is set
+    _CACHED_ATTRS = ("_hash",)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """Drops the memoized values, needed only after mutating a nested object in place"""
+        for attr in self._CACHED_ATTRS:
+            object.__setattr__(self, attr, None)
+
+    @property
+    def hash(self) -> str:
+        h = getattr(self, "_hash", None)
+        if h is None:
+            h = dhash(self)
+            object.__setattr__(self, "_hash", h)
+        return h
+
+
+@add_slots()
 @dataclass
-class SingleOutput(DataClassJson):
+class SingleOutput(DataClassJson, DataClassBinary):
     """ References a single output """
 
+    _CODEC_KIND = 1
+
     # The transaction id which contains this output
     txid: str
 
     # The index of this output in the transaction
     vout: int
 
+    def _encode(self, w: Writer):
+        w.text(self.txid)
+        w.value(self.vout)
+
+    @classmethod
+    def _decode(cls, r: Reader) -> "SingleOutput":
+        return cls(txid=r.text(), vout=r.value())
+
 
+@add_slots()
 @dataclass
-class TxOut(DataClassJson, dict):
+class TxOut(DataClassJson, DataClassBinary):
     """ A single Transaction Output """
 
+    _CODEC_KIND = 2
+
     # The amount in scoin
     amount: int
 
     # Public key hash of receiver in pubkey script
     address: str
 
+    def _encode(self, w: Writer):
+        w.value(self.amount)
+        w.text(self.address)
 
+    @classmethod
+    def _decode(cls, r: Reader) -> "TxOut":
+        return cls(amount=r.value(), address=r.text())
+
+
+@add_slots()
 @dataclass
-class TxIn(DataClassJson, dict):
+class TxIn(DataClassJson, DataClassBinary):
     """ A single Transaction Input """
 
+    _CODEC_KIND = 3
+
     # The UTXO we will be spending
     # Can be None for coinbase tx
     payout: Optional[SingleOutput]
@@ -50,6 +114,20 @@ class TxIn(DataClassJson, dict):
     sig: str
     pub_key: str
 
+    def _encode(self, w: Writer):
+        if self.payout is None:
+            w.u8(0)
+        else:
+            w.u8(1)
+            self.payout._encode(w)
+        w.text(self.sig)
+        w.text(self.pub_key)
+
+    @classmethod
+    def _decode(cls, r: Reader) -> "TxIn":
+        payout = SingleOutput._decode(r) if r.u8() else None
+        return cls(payout=payout, sig=r.text(), pub_key=r.text())
+
     # Check if the TxIn is Valid
     def is_valid(self, is_coinbase: bool) -> bool:
         if is_coinbase:
@@ -78,14 +156,18 @@ class TxIn(DataClassJson, dict):
 
 
 @dataclass
-class Transaction(DataClassJson):
+class Transaction(CachedHash, DataClassJson, DataClassBinary):
     """ A transaction as defined by bitcoin core """
 
+    _CODEC_KIND = 4
+
+    _CACHED_ATTRS = ("_hash", "_signing_message", "_size")
+
     def __str__(self):
         return self.to_json()
 
     def __hash__(self):
-        return int(dhash(self), 16)
+        return int(self.hash, 16)
 
     def __eq__(self, other):
         attrs_sam = self.is_coinbase == other.is_coinbase and self.version == other.version
@@ -102,14 +184,47 @@ class Transaction(DataClassJson):
                 break
         return attrs_same and txin_same and txout_same
 
+    @property
+    def signing_message(self) -> str:
+        """The json of this transaction with empty inputs, which is what every input signs"""
+        msg = getattr(self, "_signing_message", None)
+        if msg is None:
+            # Same output as to_json() on a copy with vin = {}, without copying anything
+            msg = json.dumps(
+                {
+                    "fees": self.fees,
+                    "is_coinbase": self.is_coinbase,
+                    "locktime": self.locktime,
+                    "timestamp": self.timestamp,
+                    "version": self.version,
+                    "vin": {},
+                    "vout": {i: {"address": tx_out.address, "amount": tx_out.amount} for i, tx_out in self.vout.items()},
+                },
+                sort_keys=True,
+            )
+            object.__setattr__(self, "_signing_message", msg)
+        return msg
+
     def sign(self, w=None):
-        sign_copy_of_tx = copy.deepcopy(self)
-        sign_copy_of_tx.vin = {}
+        # The outputs may have been edited in place since the message was cached
+        self.invalidate_cache()
         if w is None:
             w = Wallet([consts.WALLET_PRIVATE, consts.WALLET_PUBLIC])
-        sig = w.sign(sign_copy_of_tx.to_json())
+        sig = w.sign(self.signing_message)
         for i in self.vin:
             self.vin[i].sig = sig
+        # Only the hash and size cover the signatures
+        object.__setattr__(self, "_hash", None)
+        object.__setattr__(self, "_size", None)
+
+    @property
+    def size(self) -> int:
+        """Length of the json of this transaction, what it takes up of a block"""
+        size = getattr(self, "_size", None)
+        if size is None:
+            size = len(self.to_json())
+            object.__setattr__(self, "_size", size)
+        return size
 
     def is_valid(self):
 
@@ -143,25 +258,54 @@ class Transaction(DataClassJson):
         return True
 
     def object(self):
-        newtransaction = copy.deepcopy(self)
-        n_vin = {}
-        for j, tx_in in self.vin.items():
-            if not isinstance(tx_in, TxIn):
-                n_vin[int(j)] = TxIn.from_json(json.dumps(tx_in))
-            else:
-                n_vin[int(j)] = copy.deepcopy(tx_in)
-
-        n_vout = {}
-        for j, tx_out in self.vout.items():
-            if not isinstance(tx_out, TxOut):
-                n_vout[int(j)] = TxOut.from_json(json.dumps(tx_out))
-            else:
-                n_vout[int(j)] = copy.deepcopy(tx_out)
-
-        newtransaction.vin = n_vin
-        newtransaction.vout = n_vout
-
-        return newtransaction
+        """Returns this transaction with int keyed and typed vin/vout
+
+        Builds a new transaction in one pass only when something needs converting,
+        inputs and outputs that are already typed are shared rather than copied.
+        """
+        if all(type(j) is int and isinstance(tx_in, TxIn) for j, tx_in in self.vin.items()) and all(
+            type(j) is int and isinstance(tx_out, TxOut) for j, tx_out in self.vout.items()
+        ):
+            return self
+        return Transaction(
+            is_coinbase=self.is_coinbase,
+            fees=self.fees,
+            version=self.version,
+            timestamp=self.timestamp,
+            locktime=self.locktime,
+            vin={int(j): tx_in if isinstance(tx_in, TxIn) else TxIn.from_dict(tx_in) for j, tx_in in self.vin.items()},
+            vout={int(j): tx_out if isinstance(tx_out, TxOut) else TxOut.from_dict(tx_out) for j, tx_out in self.vout.items()},
+        )
+
+    def _encode(self, w: Writer):
+        w.value(self.is_coinbase)
+        w.value(self.fees)
+        w.value(self.version)
+        w.value(self.timestamp)
+        w.value(self.locktime)
+        w.u32(len(self.vin))
+        for i, tx_in in self.vin.items():
+            w.value(i)
+            tx_in._encode(w)
+        w.u32(len(self.vout))
+        for i, tx_out in self.vout.items():
+            w.value(i)
+            tx_out._encode(w)
+
+    @classmethod
+    def _decode(cls, r: Reader) -> "Transaction":
+        is_coinbase, fees, version, timestamp, locktime = r.value(), r.value(), r.value(), r.value(), r.value()
+        vin = {}
+        for _ in range(r.u32()):
+            i = r.value()
+            vin[i] = TxIn._decode(r)
+        vout = {}
+        for _ in range(r.u32()):
+            i = r.value()
+            vout[i] = TxOut._decode(r)
+        return cls(
+            is_coinbase=is_coinbase, fees=fees, version=version, timestamp=timestamp, locktime=locktime, vin=vin, vout=vout
+        )
 
     # Whether this transaction is coinbase transaction
     is_coinbase: bool
@@ -187,10 +331,13 @@ class Transaction(DataClassJson):
     vout: Dict[int, TxOut]
 
 
+@add_slots("_hash")
 @dataclass
-class BlockHeader(DataClassJson):
+class BlockHeader(CachedHash, DataClassJson, DataClassBinary):
     """ The header of a block """
 
+    _CODEC_KIND = 5
+
     # Version
     version: int
 
@@ -212,11 +359,42 @@ class BlockHeader(DataClassJson):
     # Nonce to try to get a hash below target_difficulty
     nonce: int
 
+    def hash_prefix(self) -> bytes:
+        """The hashed text of this header up to its nonce, which comes last, so mining can hash it once per template"""
+        text = str(self)
+        tail = str(self.nonce) + ")"
+        if not text.endswith("nonce=" + tail):
+            raise ValueError("BlockHeader: Nonce is not the last thing hashed")
+        return text[: -len(tail)].encode()
+
+    def _encode(self, w: Writer):
+        w.value(self.version)
+        w.value(self.height)
+        w.text(self.prev_block_hash)
+        w.text(self.merkle_root)
+        w.value(self.timestamp)
+        w.value(self.target_difficulty)
+        w.value(self.nonce)
+
+    @classmethod
+    def _decode(cls, r: Reader) -> "BlockHeader":
+        return cls(
+            version=r.value(),
+            height=r.value(),
+            prev_block_hash=r.text(),
+            merkle_root=r.text(),
+            timestamp=r.value(),
+            target_difficulty=r.value(),
+            nonce=r.value(),
+        )
+
 
 @dataclass
-class Block(DataClassJson):
+class Block(DataClassJson, DataClassBinary):
     """ A single block """
 
+    _CODEC_KIND = 6
+
     # The block header
     header: BlockHeader
 
@@ -225,13 +403,39 @@ class Block(DataClassJson):
 
     # Validate object
     def object(self):
-        newblock = copy.deepcopy(self)
-        for i, tx in enumerate(self.transactions):
-            newblock.transactions[i] = self.transactions[i].object()
-        return newblock
+        transactions = [tx.object() for tx in self.transactions]
+        if all(new is old for new, old in zip(transactions, self.transactions)):
+            return self
+        return Block(header=self.header, transactions=transactions)
 
     def __repr__(self):
-        return dhash(self.header)
+        return self.header.hash
+
+    def _encode(self, w: Writer):
+        self.header._encode(w)
+        w.u32(len(self.transactions))
+        for tx in self.transactions:
+            tw = Writer()
+            tx._encode(tw)
+            w.blob(tw.getvalue())
+
+    def merkle_tree(self) -> MerkleTree:
+        return MerkleTree.from_transactions(self.transactions)
+
+    @classmethod
+    def header_from_bytes(cls, payload: bytes) -> BlockHeader:
+        """Decodes only the header of a binary block, it comes before the transactions"""
+        return BlockHeader._decode(Reader(unpack_frame(cls._CODEC_KIND, payload)))
+
+    @classmethod
+    def _decode(cls, r: Reader) -> "Block":
+        header = BlockHeader._decode(r)
+        transactions = []
+        for _ in range(r.u32()):
+            tr = Reader(r.blob())
+            transactions.append(Transaction._decode(tr))
+            tr.done()
+        return cls(header=header, transactions=transactions)
 
     def is_valid(self) -> bool:
         # Block should be of valid size and List of Transactions should not be empty -1
@@ -254,33 +458,174 @@ class Block(DataClassJson):
                 return False
 
         # Verify merkle hash -4
-        if self.header.merkle_root != merkle_hash(self.transactions):
+        if self.header.merkle_root != self.merkle_tree().root_hex():
             logger.debug("Block: Merkle Hash failed")
             return False
         return True
 
 
+MAXIMUM_TARGET = int(consts.MAXIMUM_TARGET_DIFFICULTY, 16)
+
+
+@lru_cache(maxsize=16)
+def target_for(target_difficulty: int) -> int:
+    """The integer a header hash has to be below, hash < ceil(t) is the same as hash < t for the float t used before"""
+    return ceil(MAXIMUM_TARGET / target_difficulty)
+
+
+def meets_target_difficulty(bhash: str, target_difficulty: int) -> bool:
+    return int(bhash, 16) < target_for(target_difficulty)
+
+
+def retarget(target_difficulty: int, time_elapsed: int) -> int:
+    """The difficulty after a BLOCK_DIFFICULTY_UPDATE_INTERVAL blocks that took time_elapsed secs to mine"""
+    update = (consts.AVERAGE_BLOCK_MINE_INTERVAL * consts.BLOCK_DIFFICULTY_UPDATE_INTERVAL) / time_elapsed
+    return max(int(target_difficulty * update), 1)
+
+
+# An output as (raw txid bytes, vout)
+Outpoint = Tuple[bytes, int]
+
+
+@add_slots()
+@dataclass
+class UtxoEntry:
+    """ What the UTXO set keeps of an unspent output """
+
+    # The amount in scoin
+    amount: int
+
+    # Public key of the receiver
+    address: str
+
+    # Height of the block which created this output
+    height: int
+
+    # Whether the output comes from a coinbase transaction
+    is_coinbase: bool
+
+
 @dataclass
 class Utxo:
-    # Mapping from string repr of SingleOutput to List[TxOut, Blockheader, is_Coinbase]
-    utxo: Dict[str, List[Any]] = field(default_factory=dict)
+    # Mapping from outpoint to the unspent output
+    utxo: Dict[Outpoint, UtxoEntry] = field(default_factory=dict)
+
+    # Mapping from address to the outpoints it can spend
+    by_address: Dict[str, Set[Outpoint]] = field(default_factory=dict)
+
+    # Outputs added (the entry) or spent (None) since the set was last written to the chainstate DB
+    changes: Dict[Outpoint, Optional[UtxoEntry]] = field(default_factory=dict)
+
+    @staticmethod
+    def outpoint(so: SingleOutput) -> Optional[Outpoint]:
+        try:
+            return bytes.fromhex(so.txid), so.vout
+        except (ValueError, TypeError):
+            return None
 
-    def get(self, so: SingleOutput) -> Optional[List[Any]]:
-        so_str = so.to_json()
-        if so_str in self.utxo:
-            return self.utxo[so_str]
-        return None, None, None
+    def get(self, so: SingleOutput) -> Optional[UtxoEntry]:
+        return self.utxo.get(self.outpoint(so))
 
-    def set(self, so: SingleOutput, txout: TxOut, blockheader: BlockHeader, is_coinbase: bool):
-        so_str = so.to_json()
-        self.utxo[so_str] = [txout, blockheader, is_coinbase]
+    def set(self, so: SingleOutput, txout: TxOut, height: int, is_coinbase: bool):
+        entry = UtxoEntry(amount=txout.amount, address=txout.address, height=height, is_coinbase=is_coinbase)
+        self.add_entry(self.outpoint(so), entry)
 
     def remove(self, so: SingleOutput) -> bool:
-        so_str = so.to_json()
-        if so_str in self.utxo:
-            del self.utxo[so_str]
-            return True
-        return False
+        return self.remove_outpoint(self.outpoint(so)) is not None
+
+    def add_entry(self, outpoint: Outpoint, entry: UtxoEntry):
+        # Most outputs go to a handful of addresses, share the string between them
+        entry.address = intern(entry.address)
+        self.remove_outpoint(outpoint)
+        self.utxo[outpoint] = entry
+        self.by_address.setdefault(entry.address, set()).add(outpoint)
+        self.changes[outpoint] = entry
+
+    def remove_outpoint(self, outpoint: Outpoint) -> Optional[UtxoEntry]:
+        entry = self.utxo.pop(outpoint, None)
+        if entry is not None:
+            outpoints = self.by_address[entry.address]
+            outpoints.discard(outpoint)
+            if not outpoints:
+                del self.by_address[entry.address]
+            self.changes[outpoint] = None
+        return entry
+
+    def unspent_for(self, address: str) -> Iterator[Tuple[SingleOutput, UtxoEntry]]:
+        for outpoint in self.by_address.get(address, ()):
+            yield SingleOutput(txid=outpoint[0].hex(), vout=outpoint[1]), self.utxo[outpoint]
+
+    def balance(self, address: str) -> int:
+        return sum(self.utxo[outpoint].amount for outpoint in self.by_address.get(address, ()))
+
+    def copy(self) -> "Utxo":
+        """Copies the set without its pending changes, the entries themselves are shared"""
+        return Utxo(utxo=dict(self.utxo), by_address={a: set(ops) for a, ops in self.by_address.items()})
+
+
+@dataclass
+class BlockUndo(DataClassBinary):
+    """ What it takes to take a block back off the tip of a chain """
+
+    _CODEC_KIND = 7
+
+    # Outputs the block spent or replaced, with their entries
+    spent: List[Tuple[Outpoint, UtxoEntry]] = field(default_factory=list)
+
+    # Outputs the block created
+    created: List[Outpoint] = field(default_factory=list)
+
+    # Target difficulty of the chain before the block
+    target_difficulty: int = consts.INITIAL_BLOCK_DIFFICULTY
+
+    # Number of coins in existence before the block
+    total_scoins: int = 0
+
+    def _encode(self, w: Writer):
+        w.value(self.target_difficulty)
+        w.value(self.total_scoins)
+        w.u32(len(self.spent))
+        for (txid, vout), entry in self.spent:
+            w.blob(txid)
+            w.value(vout)
+            w.value(entry.amount)
+            w.text(entry.address)
+            w.value(entry.height)
+            w.value(entry.is_coinbase)
+        w.u32(len(self.created))
+        for txid, vout in self.created:
+            w.blob(txid)
+            w.value(vout)
+
+    @classmethod
+    def _decode(cls, r: Reader) -> "BlockUndo":
+        undo = cls(target_difficulty=r.value(), total_scoins=r.value())
+        for _ in range(r.u32()):
+            outpoint = (r.blob(), r.value())
+            entry = UtxoEntry(amount=r.value(), address=r.text(), height=r.value(), is_coinbase=r.value())
+            undo.spent.append((outpoint, entry))
+        for _ in range(r.u32()):
+            undo.created.append((r.blob(), r.value()))
+        return undo
+
+
+@dataclass
+class BlockValidation:
+    """ Outcome of Chain.validate_block """
+
+    # The stage that rejected the block, None if it is valid
+    rejected_at: Optional[str] = None
+
+    # Seconds spent in each stage that ran
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    def __bool__(self):
+        return self.rejected_at is None
+
+    def __str__(self):
+        timings = ", ".join(f"{stage} {secs * 1000:.2f}ms" for stage, secs in self.timings.items())
+        verdict = "valid" if self else "rejected at " + self.rejected_at
+        return f"{verdict} ({timings})"
 
 
 @dataclass
@@ -291,6 +636,12 @@ class Chain:
     # The list of blocks
     header_list: List[BlockHeader] = field(default_factory=list)
 
+    # Header hash of the block at each height
+    hash_list: List[str] = field(default_factory=list)
+
+    # Mapping from header hash to height
+    height_index: Dict[str, int] = field(default_factory=dict)
+
     # The UTXO Set
     utxo: Utxo = field(default_factory=Utxo)
 
@@ -300,58 +651,110 @@ class Chain:
     # The Number of Coins in existence
     total_scoins: int = 0
 
-    def __eq__(self, other):
-        for i, h in enumerate(self.header_list):
-            if dhash(h) != dhash(other.header_list[i]):
-                return False
-        return True
+    # Undo records of the last BLOCK_UNDO_DEPTH blocks, by header hash
+    undo: Dict[str, BlockUndo] = field(default_factory=dict)
 
     @classmethod
     def build_from_header_list(cls, hlist: List[BlockHeader]):
         nchain = cls()
-        nchain.header_list = []
         for header in hlist:
-            block = Block.from_json(get_block_from_db(dhash(header))).object()
-            nchain.add_block(block)
+            block = Block.from_payload(get_block_from_db(header.hash))
+            nchain.connect_block(block)
         return nchain
 
+    def push_header(self, header: BlockHeader):
+        self.height_index[header.hash] = len(self.header_list)
+        self.header_list.append(header)
+        self.hash_list.append(header.hash)
+        self.length = len(self.header_list)
+
+    def pop_header(self) -> BlockHeader:
+        header = self.header_list.pop()
+        self.hash_list.pop()
+        del self.height_index[header.hash]
+        self.length = len(self.header_list)
+        return header
+
+    def height_of(self, bhash: str) -> Optional[int]:
+        """Returns the height of the block bhash, None if it is not in the chain"""
+        return self.height_index.get(bhash)
+
     # Build the UTXO Set from scratch
     def build_utxo(self):
         for header in self.header_list:
-            block = Block.from_json(get_block_from_db(dhash(header))).object()
+            block = Block.from_payload(get_block_from_db(header.hash))
             self.update_utxo(block)
 
     # Update the UTXO Set on adding new block, *Assuming* the block being added is valid
-    def update_utxo(self, block: Block):
+    def update_utxo(self, block: Block) -> BlockUndo:
+        undo = BlockUndo(target_difficulty=self.target_difficulty, total_scoins=self.total_scoins)
         block_transactions: List[Transaction] = block.transactions
+        height = block.header.height
         for t in block_transactions:
-            thash = dhash(t)
+            txid = bytes.fromhex(t.hash)
             if not t.is_coinbase:
                 # Remove the spent outputs
                 for tinput in t.vin:
-                    so = t.vin[tinput].payout
-                    self.utxo.remove(so)
+                    outpoint = self.utxo.outpoint(t.vin[tinput].payout)
+                    entry = self.utxo.remove_outpoint(outpoint)
+                    if entry is not None:
+                        undo.spent.append((outpoint, entry))
             # Add new unspent outputs
-            for touput in t.vout:
-                self.utxo.set(SingleOutput(txid=thash, vout=touput), t.vout[touput], block.header, t.is_coinbase)
+            for touput, tx_out in t.vout.items():
+                outpoint = (txid, touput)
+                replaced = self.utxo.utxo.get(outpoint)
+                if replaced is not None:
+                    undo.spent.append((outpoint, replaced))
+                entry = UtxoEntry(amount=tx_out.amount, address=tx_out.address, height=height, is_coinbase=t.is_coinbase)
+                self.utxo.add_entry(outpoint, entry)
+                undo.created.append(outpoint)
+        return undo
+
+    def disconnect_block(self) -> bool:
+        """Takes the tip block off the chain using its undo record
 
-    def is_transaction_valid(self, transaction: Transaction):
+        Returns:
+            bool -- False if there is no undo record for the tip, the chain is left untouched then
+        """
+        if self.length == 0:
+            return False
+        undo = self.undo.pop(self.hash_list[-1], None)
+        if undo is None:
+            return False
+        for outpoint in reversed(undo.created):
+            self.utxo.remove_outpoint(outpoint)
+        for outpoint, entry in reversed(undo.spent):
+            self.utxo.add_entry(outpoint, entry)
+        self.pop_header()
+        self.target_difficulty = undo.target_difficulty
+        self.total_scoins = undo.total_scoins
+        return True
+
+    def is_transaction_valid(self, transaction: Transaction, sig_checks: Optional[List[SigCheck]] = None):
+        """Validates a transaction against the UTXO set of the chain
+
+        Arguments:
+            transaction {Transaction} -- The transaction to validate
+            sig_checks {Optional[List[SigCheck]]} -- If given, the input signatures are appended here to be
+                verified later as a batch instead of being verified now
+        """
         if not transaction.is_valid():
             return False
+        return self.is_spend_valid(transaction, sig_checks)
 
+    def is_spend_valid(self, transaction: Transaction, sig_checks: Optional[List[SigCheck]] = None):
+        """The part of is_transaction_valid that needs the UTXO set, for transactions already checked on their own"""
         sum_of_all_inputs = 0
         sum_of_all_outputs = 0
-        sign_copy_of_tx = copy.deepcopy(transaction)
-        sign_copy_of_tx.vin = {}
         for inp, tx_in in transaction.vin.items():
             if tx_in.payout is not None:
-                tx_out, block_hdr, is_coinbase = self.utxo.get(tx_in.payout)
+                utxo_entry = self.utxo.get(tx_in.payout)
                 # ensure the TxIn is present in utxo, i.e exists and has not been spent
-                if block_hdr is not None:
-                    if is_coinbase:
+                if utxo_entry is not None:
+                    if utxo_entry.is_coinbase:
                         # check for coinbase TxIn Maturity
-                        if not self.length - block_hdr.height >= consts.COINBASE_MATURITY:
-                            logger.debug(str(self.length) + " " + str(block_hdr.height))
+                        if not self.length - utxo_entry.height >= consts.COINBASE_MATURITY:
+                            logger.debug(str(self.length) + " " + str(utxo_entry.height))
                             logger.debug("Chain: Coinbase not matured")
                             return False
                 else:
@@ -360,11 +763,14 @@ class Chain:
                     return False
 
                 # Verify that the Signature is valid for all inputs
-                if not Wallet.verify(sign_copy_of_tx.to_json(), tx_in.sig, tx_out.address):
+                check = (transaction.signing_message, tx_in.sig, utxo_entry.address)
+                if sig_checks is not None:
+                    sig_checks.append(check)
+                elif not verify_one(check):
                     logger.debug("Chain: Invalid Signature")
                     return False
 
-                sum_of_all_inputs += tx_out.amount
+                sum_of_all_inputs += utxo_entry.amount
 
         if sum_of_all_inputs > consts.MAX_SCOINS_POSSIBLE or sum_of_all_inputs < 0:
             logger.debug("Chain: Invalid input Amount")
@@ -390,57 +796,44 @@ class Chain:
 
         return True
 
-    def is_block_valid(self, block: Block):
-        # Check if the block is valid -1
-        if not block.is_valid():
-            logger.debug("Block is not valid")
+    def is_header_valid(self, header: BlockHeader) -> bool:
+        """Checks a header that is to extend this chain, needs nothing but the header"""
+        # Ensure the prev block header matches the previous block hash in the Chain
+        if len(self.header_list) > 0 and not self.hash_list[-1] == header.prev_block_hash:
+            logger.debug("Chain: Block prev header does not match previous block")
             return False
 
-        # Block hash should have proper difficulty -2
-        if not block.header.target_difficulty >= self.target_difficulty:
+        # Block hash should have proper difficulty
+        if not header.target_difficulty >= self.target_difficulty:
             logger.debug("Chain: BlockHeader has invalid difficulty")
             return False
-        if not self.is_proper_difficulty(dhash(block.header)):
+        if not self.is_proper_difficulty(header.hash):
             logger.debug("Chain: Block has invalid POW")
             return False
 
-        # Block should not have been mined more than 2 hours in the future -3
-        difference = get_time_difference_from_now_secs(block.header.timestamp)
+        # Block should not have been mined more than 2 hours in the future
+        difference = get_time_difference_from_now_secs(header.timestamp)
         if difference > consts.BLOCK_MAX_TIME_FUTURE_SECS:
             logger.debug("Block: Time Stamp not valid")
             return False
 
-        # Reject if timestamp is the median time of the last 11 blocks or before -5
+        # Reject if timestamp is the median time of the last 11 blocks or before
         if len(self.header_list) > 11:
-            last_11 = self.header_list[-11:]
-            last_11_timestamp = []
-            for bl in last_11:
-                last_11_timestamp.append(bl.timestamp)
-            med = median(last_11_timestamp)
-            if block.header.timestamp <= med:
+            med = median(hdr.timestamp for hdr in self.header_list[-11:])
+            if header.timestamp <= med:
                 logger.debug("Chain: Median time past")
                 return False
+        return True
 
-        # Ensure the prev block header matches the previous block hash in the Chain -4
-        if len(self.header_list) > 0 and not dhash(self.header_list[-1]) == block.header.prev_block_hash:
-            logger.debug("Chain: Block prev header does not match previous block")
-            return False
-
-        # Validating each transaction in block
+    def are_transactions_valid(self, block: Block, sig_checks: List[SigCheck]) -> bool:
+        """Checks the transactions of a structurally valid block against the UTXO set, leaving the signatures in sig_checks"""
         for tx in block.transactions:
-            if not self.is_transaction_valid(tx):
+            if not self.is_spend_valid(tx, sig_checks):
                 logger.debug("Chain: Transaction not valid")
                 return False
 
         # Validate that the first coinbase Transaction has valid Block reward and fees
-        remaining_transactions = block.transactions[1:]
-        fee_total = 0
-        for tx in remaining_transactions:
-            if not self.is_transaction_valid(tx):
-                logger.debug("Chain: Transaction not valid")
-                return False
-            else:
-                fee_total += tx.fees
+        fee_total = sum(tx.fees for tx in block.transactions[1:])
         if not len(block.transactions[0].vout) == 2:
             logger.debug("Chain: Coinbase vout length != 2")
             return False
@@ -454,14 +847,50 @@ class Chain:
             return False
         return True
 
+    def validate_block(self, block: Block) -> "BlockValidation":
+        """Runs the validation stages in order, cheapest first, and stops at the first that fails
+
+        header -- PoW, difficulty, timestamps and linkage, from the header alone
+        structure -- size, coinbase placement, transactions on their own and the merkle root
+        contextual -- inputs against the UTXO set, amounts, fees and block reward
+        signatures -- the input signatures, as one batch
+        """
+        result = BlockValidation()
+        sig_checks: List[SigCheck] = []
+        stages = (
+            ("header", lambda: self.is_header_valid(block.header)),
+            ("structure", block.is_valid),
+            ("contextual", lambda: self.are_transactions_valid(block, sig_checks)),
+            ("signatures", lambda: verify_batch(sig_checks)),
+        )
+        for stage, check in stages:
+            tss = time.perf_counter()
+            valid = check()
+            result.timings[stage] = time.perf_counter() - tss
+            if not valid:
+                result.rejected_at = stage
+                break
+        logger.debug(f"Chain: Block {block.header.hash} {result}")
+        return result
+
+    def is_block_valid(self, block: Block) -> bool:
+        return bool(self.validate_block(block))
+
     def add_block(self, block: Block) -> bool:
+        if self.connect_block(block):
+            add_block_to_db(block)
+            return True
+        return False
+
+    def connect_block(self, block: Block) -> bool:
+        """Validates the block against the chain and applies it on top, without storing the block"""
         if self.is_block_valid(block):
-            self.header_list.append(block.header)
-            self.update_utxo(block)
+            self.push_header(block.header)
+            self.undo[block.header.hash] = self.update_utxo(block)
             self.update_target_difficulty()
-            self.length = len(self.header_list)
             self.total_scoins = self.current_block_reward()
-            add_block_to_db(block)
+            if self.length > consts.BLOCK_UNDO_DEPTH:
+                self.undo.pop(self.hash_list[-consts.BLOCK_UNDO_DEPTH - 1], None)
             logger.info("Chain: Added Block " + str(block))
             return True
         return False
@@ -471,15 +900,11 @@ class Chain:
         length = len(self.header_list)
         if length > 0 and length % dui == 0:
             time_elapsed = self.header_list[-1].timestamp - self.header_list[-dui].timestamp
-            update = (consts.AVERAGE_BLOCK_MINE_INTERVAL * dui) / time_elapsed
-            self.target_difficulty = int(self.target_difficulty * update)
-            if self.target_difficulty < 1:
-                self.target_difficulty = 1
+            self.target_difficulty = retarget(self.target_difficulty, time_elapsed)
             logger.debug(f"Chain: Updating Block Difficulty, new difficulty {self.target_difficulty}")
 
     def is_proper_difficulty(self, bhash: str) -> bool:
-        target_difficulty = int(consts.MAXIMUM_TARGET_DIFFICULTY, 16) / self.target_difficulty
-        return int(bhash, 16) < target_difficulty
+        return meets_target_difficulty(bhash, self.target_difficulty)
 
     def current_block_reward(self) -> int:
         """Returns the current block reward
@@ -493,58 +918,366 @@ class Chain:
         return 0
 
 
+class BlockStatus(IntEnum):
+    # Stored with its header checked, the rest is checked once its branch has the most work
+    HEADER_VALID = 1
+    # Has been connected to the active chain
+    VALID = 2
+    # Failed to connect, nothing built on it is accepted
+    INVALID = 3
+
+
+class AddBlockResult(IntEnum):
+    # Invalid or not built on a known valid block
+    REJECTED = 0
+    # Stored on a side branch, only its header and structure were checked
+    STORED = 1
+    # Fully validated and connected to the active chain, extending it or by a reorg
+    CONNECTED = 2
+
+
+@add_slots()
+@dataclass(eq=False)
+class BlockNode:
+    """ A known block, whether on the active chain or on a side branch """
+
+    header: BlockHeader
+
+    # The node of the previous block, None for genesis
+    parent: Optional["BlockNode"]
+
+    height: int
+
+    # Sum of the target difficulties of the block and all blocks before it
+    chain_work: int
+
+    status: BlockStatus
+
+    # The difficulty a block built on this one must claim, as the active chain would have it after this block
+    next_target_difficulty: int
+
+    # Number of known blocks built on this one
+    children: int = 0
+
+    @property
+    def hash(self) -> str:
+        return self.header.hash
+
+
 class BlockChain:
 
     block_lock = RLock()
-    block_ref_count: Counter = Counter()
 
     def __init__(self):
+        # The chain ending at best, the only one with a UTXO set
         self.active_chain: Chain = Chain()
-        self.chains: List[Chain] = []
-        self.chains.append(self.active_chain)
-        self.mempool: Set[Transaction] = set()
-
-    def remove_transactions_from_mempool(self, block: Block):
-        """Removes transaction from the mempool based on a new received block
-
-        Arguments:
-            block {Block} -- The block which is received
-        """
-        new_mempool = set()
-        for x in self.mempool:
-            DONE = True
-            for t in block.transactions:
-                if dhash(x) == dhash(t):
-                    DONE = False
-            if DONE:
-                new_mempool.add(x)
-        self.mempool = new_mempool
+        # Every known block by header hash
+        self.block_index: Dict[str, BlockNode] = {}
+        # Blocks nothing is built on yet, one of them is best
+        self.tips: Set[BlockNode] = set()
+        # The tip with the most work
+        self.best: Optional[BlockNode] = None
+        self.mempool = Mempool()
+        # The chain last written to the chainstate DB and its length at the time
+        self.chainstate_chain: Optional[Chain] = None
+        self.chainstate_length = 0
+
+    @staticmethod
+    def next_target_difficulty(header: BlockHeader, parent: Optional[BlockNode]) -> int:
+        """The difficulty required after header on its own branch, following Chain.update_target_difficulty"""
+        if parent is None:
+            return consts.INITIAL_BLOCK_DIFFICULTY
+        target_difficulty = parent.next_target_difficulty
+        dui = consts.BLOCK_DIFFICULTY_UPDATE_INTERVAL
+        if (parent.height + 2) % dui == 0:
+            first = parent
+            for _ in range(dui - 2):
+                first = first.parent
+            target_difficulty = retarget(target_difficulty, header.timestamp - first.header.timestamp)
+        return target_difficulty
+
+    def add_node(self, header: BlockHeader, parent: Optional[BlockNode], status: BlockStatus) -> BlockNode:
+        next_target_difficulty = self.next_target_difficulty(header, parent)
+        if parent is None:
+            node = BlockNode(
+                header=header,
+                parent=None,
+                height=0,
+                chain_work=header.target_difficulty,
+                status=status,
+                next_target_difficulty=next_target_difficulty,
+            )
+        else:
+            node = BlockNode(
+                header=header,
+                parent=parent,
+                height=parent.height + 1,
+                chain_work=parent.chain_work + header.target_difficulty,
+                status=status,
+                next_target_difficulty=next_target_difficulty,
+            )
+            parent.children += 1
+            self.tips.discard(parent)
+        self.block_index[header.hash] = node
+        self.tips.add(node)
+        return node
+
+    def is_on_active_chain(self, node: BlockNode) -> bool:
+        return self.active_chain.height_of(node.hash) == node.height
+
+    def find_fork(self, node: BlockNode) -> BlockNode:
+        """Returns the last block the branch of node shares with the active chain"""
+        while not self.is_on_active_chain(node):
+            node = node.parent
+        return node
+
+    @staticmethod
+    def branch(tip: BlockNode, fork: BlockNode) -> List[BlockNode]:
+        """Returns the nodes after fork up to and including tip, oldest first"""
+        nodes = []
+        while tip is not fork:
+            nodes.append(tip)
+            tip = tip.parent
+        nodes.reverse()
+        return nodes
+
+    def side_branches(self) -> List[List[BlockHeader]]:
+        """Returns the headers of every side branch, from where it leaves the active chain up to its tip"""
+        return [[node.header for node in self.branch(tip, self.find_fork(tip))] for tip in self.tips if tip is not self.best]
 
     def update_active_chain(self):
-        self.active_chain = max(self.chains, key=attrgetter("length"))
-        max_length = self.active_chain.length
-        # Try removing old chains
-        new_chains = []
-        for chain in self.chains:
-            if chain.length > max_length - consts.FORK_CHAIN_HEIGHT:
-                new_chains.append(chain)
-            else:
-                for hdr in chain.header_list:
-                    if BlockChain.block_ref_count[dhash(hdr)] == 1:
-                        del BlockChain.block_ref_count[dhash(hdr)]
-                        remove_block_from_db(dhash(hdr))
-                    else:
-                        BlockChain.block_ref_count[dhash(hdr)] -= 1
-
-        self.chains = new_chains
+        """Drops side branches that fell FORK_CHAIN_HEIGHT behind the best tip and saves the active chain"""
+        min_height = self.best.height - consts.FORK_CHAIN_HEIGHT
+        for tip in list(self.tips):
+            if tip is self.best or tip.height > min_height:
+                continue
+            self.tips.discard(tip)
+            node = tip
+            while node.children == 0 and not self.is_on_active_chain(node):
+                del self.block_index[node.hash]
+                remove_block_from_db(node.hash)
+                node = node.parent
+                node.children -= 1
+
         # Save Active Chain to DB
         write_header_list_to_db(self.active_chain.header_list)
+        self.save_chainstate()
+
+    def disconnect_to(self, fork: BlockNode):
+        """Takes blocks off the active chain until fork is its tip"""
+        chain = self.active_chain
+        while chain.length > fork.height + 1:
+            if not chain.disconnect_block():
+                logger.debug("BlockChain: Fork point is below the undo records, rebuilding the chain")
+                self.active_chain = Chain.build_from_header_list(chain.header_list[: fork.height + 1])
+                break
+        self.chainstate_length = min(self.chainstate_length, fork.height + 1)
 
+    def connect_branch(self, nodes: List[BlockNode]) -> List[Block]:
+        """Connects the blocks of nodes to the active chain in order
+
+        Returns:
+            List[Block] -- The blocks connected, fewer than nodes if one is invalid
+        """
+        blocks = []
+        for node in nodes:
+            payload = get_block_from_db(node.hash)
+            if payload is None:
+                break
+            block = Block.from_payload(payload)
+            if not self.active_chain.connect_block(block):
+                break
+            node.status = BlockStatus.VALID
+            blocks.append(block)
+        return blocks
+
+    def reorganize(self, new_best: BlockNode) -> bool:
+        """Moves the active chain over to the branch ending at new_best
+
+        The blocks above the fork point are disconnected with their undo records, then the blocks of the
+        new branch are validated and connected. If one of them is invalid, it and the blocks after it are
+        marked INVALID and the old branch is connected back.
+
+        Returns:
+            bool -- True if new_best is now the tip of the active chain
+        """
+        old_best = self.best
+        fork = self.find_fork(new_best)
+        old_branch = self.branch(old_best, fork)
+        new_branch = self.branch(new_best, fork)
+
+        self.disconnect_to(fork)
+        new_blocks = self.connect_branch(new_branch)
+        connected = len(new_blocks)
+        if connected < len(new_branch):
+            logger.info(f"BlockChain: Block {new_branch[connected].hash} is invalid, keeping the current chain")
+            # The blocks before it were only connected for this attempt
+            for node in new_branch[:connected]:
+                node.status = BlockStatus.HEADER_VALID
+            for node in new_branch[connected:]:
+                node.status = BlockStatus.INVALID
+            self.disconnect_to(fork)
+            if len(self.connect_branch(old_branch)) < len(old_branch):
+                logger.error("BlockChain: Could not connect the old branch back")
+            return False
+
+        self.best = new_best
+        self.update_mempool_after_reorg(old_branch, new_blocks)
+        logger.info(f"BlockChain: Reorganized {len(old_branch)} blocks deep to a chain of length {self.active_chain.length}")
+        return True
+
+    def update_mempool_after_reorg(self, old_branch: List[BlockNode], new_blocks: List[Block]):
+        """Moves the transactions of the disconnected blocks that the new branch did not include back to the
+        mempool, and drops what no longer spends outputs of the active chain
+        """
+        new_txids = set()
+        for block in new_blocks:
+            self.mempool.remove_block_transactions(block)
+            new_txids.update(tx.hash for tx in block.transactions)
+        returned = 0
+        for node in old_branch:
+            payload = get_block_from_db(node.hash)
+            if payload is None:
+                continue
+            for tx in Block.from_payload(payload).transactions:
+                if not tx.is_coinbase and tx.hash not in new_txids and self.mempool.add(tx):
+                    returned += 1
+        removed = self.mempool.remove_missing_inputs(self.active_chain.utxo.utxo)
+        logger.debug(f"BlockChain: Returned {returned} transactions to the mempool, removed {removed} left unspendable")
+
+    @staticmethod
+    def is_side_header_valid(header: BlockHeader, parent: BlockNode) -> bool:
+        """Checks the header of a block that does not extend the active chain, it must claim at least the
+        difficulty its own branch requires after parent and meet it
+        """
+        if header.target_difficulty < parent.next_target_difficulty:
+            logger.debug("BlockChain: Side block claims too low a difficulty for its branch")
+            return False
+        if not meets_target_difficulty(header.hash, header.target_difficulty):
+            logger.debug("BlockChain: Side block has invalid POW")
+            return False
+        if get_time_difference_from_now_secs(header.timestamp) > consts.BLOCK_MAX_TIME_FUTURE_SECS:
+            logger.debug("Block: Time Stamp not valid")
+            return False
+        return True
+
+    def is_side_block_valid(self, block: Block) -> bool:
+        """Checks a block that does not extend the active chain as far as that is possible without its
+        branch's UTXO set, the rest is checked if the branch ever has the most work
+        """
+        if not self.is_side_header_valid(block.header, self.block_index[block.header.prev_block_hash]):
+            return False
+        if not block.is_valid():
+            logger.debug("Block is not valid")
+            return False
+        return True
+
+    @lock(block_lock)
+    def precheck_header(self, header: BlockHeader) -> bool:
+        """Checks the header of a block received from a peer before the rest of the block is decoded or validated
+
+        Returns:
+            bool -- False if the block does not build on a known valid block, is too far behind
+                the best tip to ever be used or fails the header checks
+        """
+        parent = self.block_index.get(header.prev_block_hash)
+        if parent is None:
+            logger.debug("BlockChain: Block does not build on a known block")
+            return False
+        if parent.status == BlockStatus.INVALID:
+            logger.debug("BlockChain: Block builds on an invalid block")
+            return False
+        if parent.height + 1 <= self.best.height - consts.FORK_CHAIN_HEIGHT:
+            logger.debug("BlockChain: Block is too far behind the best tip")
+            return False
+        if parent is self.best:
+            return self.active_chain.is_header_valid(header)
+        return self.is_side_header_valid(header, parent)
+
+    def save_chainstate(self):
+        """Writes the UTXO set and headers of the active chain to the chainstate DB
+
+        Only the changes since the last write are written while the chain is only extended or
+        reorganized, it is rewritten when it had to be rebuilt.
+        """
+        chain = self.active_chain
+        if chain.length == 0:
+            return
+        meta = {
+            "tip": chain.hash_list[-1],
+            "length": chain.length,
+            "target_difficulty": chain.target_difficulty,
+            "total_scoins": chain.total_scoins,
+        }
+        rewrite = chain is not self.chainstate_chain
+        start = 0 if rewrite else self.chainstate_length
+        headers = [(height, hdr.hash, hdr.to_bytes()) for height, hdr in enumerate(chain.header_list[start:], start)]
+        undo = [
+            (height, hdr.hash, chain.undo[hdr.hash].to_bytes())
+            for height, hdr in enumerate(chain.header_list[start:], start)
+            if hdr.hash in chain.undo
+        ]
+        changes = chain.utxo.utxo if rewrite else chain.utxo.changes
+        spent = [outpoint for outpoint, entry in changes.items() if entry is None]
+        created = [
+            (outpoint[0], outpoint[1], entry.amount, entry.address, entry.height, entry.is_coinbase)
+            for outpoint, entry in changes.items()
+            if entry is not None
+        ]
+        write_chainstate(meta, headers, spent, created, undo, rewrite=rewrite)
+        self.chainstate_chain = chain
+        self.chainstate_length = chain.length
+        chain.utxo.changes.clear()
+
+    def restore_from_chainstate(self) -> bool:
+        """Loads the active chain from the chainstate DB instead of replaying its blocks
+
+        Returns:
+            bool -- False if there is no usable chainstate and the blocks have to be replayed
+        """
+        try:
+            state = read_chainstate()
+            if state is None:
+                return False
+            meta, headers, rows, undo_rows = state
+            chain = Chain()
+            for hdr in headers:
+                chain.push_header(BlockHeader.from_bytes(hdr))
+            if chain.length != meta["length"] or chain.hash_list[-1] != meta["tip"]:
+                logger.error("BlockChain: Chainstate does not match its tip, replaying blocks instead")
+                return False
+            if not check_block_in_db(meta["tip"]):
+                logger.error("BlockChain: Chainstate tip is not in the block DB, replaying blocks instead")
+                return False
+            for txid, vout, amount, address, height, is_coinbase in rows:
+                entry = UtxoEntry(amount=amount, address=address, height=height, is_coinbase=bool(is_coinbase))
+                chain.utxo.add_entry((txid, vout), entry)
+            chain.utxo.changes.clear()
+            for height, hhash, undo in undo_rows:
+                if chain.height_of(hhash) == height:
+                    chain.undo[hhash] = BlockUndo.from_bytes(undo)
+        except Exception as e:
+            logger.error("BlockChain: Could not read chainstate " + str(e))
+            return False
+
+        chain.target_difficulty = meta["target_difficulty"]
+        chain.total_scoins = meta["total_scoins"]
+        self.active_chain = chain
+        self.block_index = {}
+        self.tips = set()
+        node = None
+        for hdr in chain.header_list:
+            node = self.add_node(hdr, node, BlockStatus.VALID)
+        self.best = node
+        self.chainstate_chain = chain
+        self.chainstate_length = chain.length
+        logger.info(f"BlockChain: Restored chain of length {chain.length} from chainstate")
+        return True
 
     def build_from_header_list(self, hlist: List[str]):
         try:
             for header in hlist:
-                block = Block.from_json(get_block_from_db(header)).object()
+                block = Block.from_payload(get_block_from_db(header))
                 if block:
                     self.add_block(block)
                 else:
@@ -553,50 +1286,53 @@ class BlockChain:
             logger.error("Blockchain: Exception " + str(e) + str(block))
 
     @lock(block_lock)
-    def add_block(self, block: Block):
-        # if check_block_in_db(dhash(block.header)):
-        #     logger.debug("Chain: AddBlock: Block already exists")
-        #     return True
+    def add_block(self, block: Block) -> AddBlockResult:
+        """Adds a block to the block index and moves the active chain to the branch with the most work
 
-        blockAdded = False
+        Blocks extending the active chain are validated and connected right away, blocks on side branches
+        are only stored until their branch has more work than the active chain.
 
-        for chain in self.chains:
-            if chain.length == 0 or block.header.prev_block_hash == dhash(chain.header_list[-1]):
-                if chain.add_block(block):
-                    BlockChain.block_ref_count[dhash(block.header)] += 1
+        Returns:
+            AddBlockResult -- Falsy if the block is invalid or does not build on a known block, STORED if it
+                was only stored on a side branch, CONNECTED if it is fully validated
+        """
+        node = self.block_index.get(block.header.hash)
+        if node is not None:
+            logger.debug("BlockChain: Block already known")
+            if node.status == BlockStatus.INVALID:
+                return AddBlockResult.REJECTED
+            return AddBlockResult.CONNECTED if node.status == BlockStatus.VALID else AddBlockResult.STORED
+
+        parent = self.block_index.get(block.header.prev_block_hash)
+        if parent is None and self.block_index:
+            logger.debug("BlockChain: Block does not build on a known block")
+            return AddBlockResult.REJECTED
+        if parent is not None and parent.status == BlockStatus.INVALID:
+            logger.debug("BlockChain: Block builds on an invalid block")
+            return AddBlockResult.REJECTED
+
+        if parent is self.best:
+            if not self.active_chain.connect_block(block):
+                return AddBlockResult.REJECTED
+            add_block_to_db(block)
+            self.best = self.add_node(block.header, parent, BlockStatus.VALID)
+            # Remove the transactions from MemPool
+            self.mempool.remove_block_transactions(block)
+            result = AddBlockResult.CONNECTED
+        else:
+            if not self.is_side_block_valid(block):
+                return AddBlockResult.REJECTED
+            add_block_to_db(block)
+            node = self.add_node(block.header, parent, BlockStatus.HEADER_VALID)
+            logger.debug(f"BlockChain: Stored side branch block at height {node.height}")
+            result = AddBlockResult.STORED
+            if node.chain_work > self.best.chain_work:
+                if not self.reorganize(node):
                     self.update_active_chain()
-                    if chain is self.active_chain:
-                        # Remove the transactions from MemPool
-                        self.remove_transactions_from_mempool(block)
-                    blockAdded = True
-
-        if blockAdded:
-            return True
-
-        # Check if we need to fork
-        self.chains.sort(key=attrgetter("length"), reverse=True)
-        new_chains = copy.deepcopy(self.chains)
-        for chain in new_chains:
-            hlist = copy.deepcopy(chain.header_list)
-            for h in reversed(hlist):
-                # Check if block can be added for current header
-                if dhash(h) == block.header.prev_block_hash:
-                    newhlist = []
-                    for hh in chain.header_list:
-                        newhlist.append(hh)
-                        if dhash(hh) == block.header.prev_block_hash:
-                            break
-
-                    nchain = Chain.build_from_header_list(newhlist)
-                    if nchain.add_block(block):
-                        for header in nchain.header_list:
-                            BlockChain.block_ref_count[dhash(header)] += 1
-                        if nchain not in self.chains:
-                            self.chains.append(nchain)
-                        self.update_active_chain()
-                        logger.debug(f"There was a soft fork and a new chain was created with length {nchain.length}")
-                        return True
-        return False
+                    return AddBlockResult.REJECTED
+                result = AddBlockResult.CONNECTED
+        self.update_active_chain()
+        return result
 
 
 genesis_block_transaction = [
@@ -630,5 +1366,5 @@ genesis_block = Block(header=genesis_block_header, transactions=genesis_block_tr
 if __name__ == "__main__":
     logger.debug(genesis_block)
     gb_json = genesis_block.to_json()
-    gb = Block.from_json(gb_json).object()
+    gb = Block.from_json(gb_json)
     print(gb.transactions[0].vout[0].amount)
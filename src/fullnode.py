@@ -1,21 +1,23 @@
 import json
 import time
 from functools import lru_cache
-from multiprocessing import Pool, Process
-from threading import Thread, Timer
-from typing import Any, Dict, List
+from threading import Event, Thread, Timer
+from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime
 
-import requests
 import waitress
 from bottle import BaseTemplate, Bottle, request, response, static_file, template
 
 import utils.constants as consts
-from core import Block, BlockChain, SingleOutput, Transaction, TxIn, TxOut, genesis_block
+from broadcaster import INV_BLOCK, INV_TX, Broadcaster, Payload
+from core import AddBlockResult, Block, BlockChain, BlockHeader, BlockStatus, Transaction, TxIn, TxOut, genesis_block
 from miner import Miner
+from peer_client import PEER_CLIENT
 from utils.logger import logger
+from utils.codec import is_binary, json_from_payload
 from utils.storage import get_block_from_db, get_wallet_from_db, read_header_list_from_db
-from utils.utils import compress, decompress, dhash, get_time_difference_from_now_secs
+from utils.utils import compress, decompress, get_time_difference_from_now_secs
+from verifier import SIGNATURE_CACHE
 from wallet import Wallet
 
 app = Bottle()
@@ -29,33 +31,75 @@ PEER_LIST: List[Dict[str, Any]] = []
 
 MY_WALLET = Wallet()
 
-miner = Miner()
+BROADCASTER = Broadcaster(
+    payload_for=lambda kind, item_hash: inventory_payload(kind, item_hash),
+    have=lambda kind, item_hash: have_inventory(kind, item_hash),
+    deliver=lambda kind, payload: deliver_inventory(kind, payload),
+)
+
+miner = Miner(on_block=lambda block: process_mined_block(block))
+
+# Set to have the mining thread look for new work right away
+MINING_WAKEUP = Event()
 
 
 def mining_thread_task():
+    last_summary = time.time()
     while True:
+        BLOCKCHAIN.mempool.expire()
+        miner.metrics.sample()
+        if time.time() - last_summary >= consts.MINER_STATS_LOG_INTERVAL:
+            logger.info(miner.metrics.summary())
+            last_summary = time.time()
         if not miner.is_mining():
-            mlist = list(BLOCKCHAIN.mempool)
-            fees, size = miner.calculate_transaction_fees_and_size(mlist)
+            fees, size = BLOCKCHAIN.mempool.total_fees, BLOCKCHAIN.mempool.total_size
             time_diff = -get_time_difference_from_now_secs(BLOCKCHAIN.active_chain.header_list[-1].timestamp)
             if (
                 fees >= 1
-                or (size >= consts.MAX_BLOCK_SIZE_KB / 1.6)
+                or (size >= consts.MAX_BLOCK_SIZE_KB * 1024 / 1.6)
                 or (time_diff > consts.AVERAGE_BLOCK_MINE_INTERVAL / consts.BLOCK_MINING_SPEEDUP)
             ):
-                miner.start_mining(BLOCKCHAIN.mempool, BLOCKCHAIN.active_chain, MY_WALLET.public_key)
-        time.sleep(5)
+                # The template is built from a consistent tip
+                with BLOCKCHAIN.block_lock:
+                    miner.start_mining(BLOCKCHAIN.mempool, BLOCKCHAIN.active_chain, MY_WALLET.public_key)
+        # Woken early when the tip changes
+        MINING_WAKEUP.wait(5)
+        MINING_WAKEUP.clear()
+
+
+def announce_to_all_peers(kind: str, item_hash: str):
+    BROADCASTER.announce([get_peer_url(peer) for peer in PEER_LIST], kind, item_hash)
+
+
+def have_inventory(kind: str, item_hash: str) -> bool:
+    if kind == INV_BLOCK:
+        return item_hash in BLOCKCHAIN.block_index
+    return item_hash in BLOCKCHAIN.mempool
+
+
+def deliver_inventory(kind: str, payload: Payload):
+    """Processes an item fetched from a peer as if the peer had posted it"""
+    if kind == INV_BLOCK:
+        process_new_block(payload)
+    else:
+        process_new_transaction(payload)
 
 
-def send_to_all_peers(url, data):
-    def request_task(peers, url, data):
-        for peer in peers:
-            try:
-                requests.post(get_peer_url(peer) + url, data=data, timeout=(5, 1))
-            except Exception as e:
-                logger.debug("Server: Requests: Error while sending data in process" + str(peer))
+def inventory_payload(kind: str, item_hash: str) -> Optional[Tuple[str, Payload]]:
+    """Returns where to post an item a peer asked for and its payload, None if we do not have it
 
-    Process(target=request_task, args=(PEER_LIST, url, data), daemon=True).start()
+    Side branch blocks are stored but not fully validated, they are only served once connected.
+    """
+    if kind == INV_BLOCK:
+        node = BLOCKCHAIN.block_index.get(item_hash)
+        if node is not None and node.status == BlockStatus.VALID:
+            return "/newblock", cached_get_block(item_hash, consts.WIRE_FORMAT)
+        return None
+    if kind == INV_TX:
+        tx = BLOCKCHAIN.mempool.get(item_hash)
+        if tx is not None:
+            return "/newtransaction", tx.to_payload(consts.WIRE_FORMAT)
+    return None
 
 
 def start_mining_thread():
@@ -65,7 +109,7 @@ def start_mining_thread():
 
 def fetch_peer_list() -> List[Dict[str, Any]]:
     try:
-        r = requests.post(consts.SEED_SERVER_URL, data={"port": consts.MINER_SERVER_PORT})
+        r = PEER_CLIENT.post(consts.SEED_SERVER_URL, data={"port": consts.MINER_SERVER_PORT})
         peer_list = json.loads(r.text)
         return peer_list
     except Exception as e:
@@ -82,7 +126,7 @@ def greet_peer(peer: Dict[str, Any]) -> bool:
         url = get_peer_url(peer)
         data = {"port": consts.MINER_SERVER_PORT, "version": consts.MINER_VERSION, "blockheight": BLOCKCHAIN.active_chain.length}
         # Send a POST request to the peer
-        r = requests.post(url + "/greetpeer", data=data)
+        r = PEER_CLIENT.post(url, "/greetpeer", data=data)
         data = json.loads(r.text)
         # Update the peer data in the peer list with the new data received from the peer.
         if data.get("blockheight", None):
@@ -97,12 +141,12 @@ def greet_peer(peer: Dict[str, Any]) -> bool:
 
 
 def receive_block_from_peer(peer: Dict[str, Any], header_hash) -> Block:
-    r = requests.post(get_peer_url(peer) + "/getblock", data={"headerhash": header_hash})
-    return Block.from_json(decompress(r.text)).object()
+    r = PEER_CLIENT.post(get_peer_url(peer), "/getblock", data={"headerhash": header_hash, "format": consts.WIRE_FORMAT})
+    return Block.from_payload(r.content)
 
 
 def check_block_with_peer(peer, hhash):
-    r = requests.post(get_peer_url(peer) + "/checkblock", data={"headerhash": hhash})
+    r = PEER_CLIENT.post(get_peer_url(peer), "/checkblock", data={"headerhash": hhash})
     result = json.loads(r.text)
     if result:
         return True
@@ -110,7 +154,7 @@ def check_block_with_peer(peer, hhash):
 
 
 def get_block_header_hash(height):
-    return dhash(BLOCKCHAIN.active_chain.header_list[height])
+    return BLOCKCHAIN.active_chain.hash_list[height]
 
 
 def find_fork_height(peer):
@@ -131,7 +175,7 @@ def find_fork_height(peer):
 
 def sync(max_peer):
     fork_height = find_fork_height(max_peer)
-    r = requests.post(get_peer_url(max_peer) + "/getblockhashes", data={"myheight": fork_height})
+    r = PEER_CLIENT.post(get_peer_url(max_peer), "/getblockhashes", data={"myheight": fork_height})
     hash_list = json.loads(decompress(r.text.encode()))
     # logger.debug("Received the Following HashList from peer " + str(get_peer_url(max_peer)))
     # logger.debug(hash_list)
@@ -164,12 +208,7 @@ def sync_with_peers():
 
 
 def check_balance():
-    current_balance = 0
-    for x, utxo_list in BLOCKCHAIN.active_chain.utxo.utxo.items():
-        tx_out = utxo_list[0]
-        if tx_out.address == MY_WALLET.public_key:
-            current_balance += int(tx_out.amount)
-    return int(current_balance)
+    return int(BLOCKCHAIN.active_chain.utxo.balance(MY_WALLET.public_key))
 
 
 def send_bounty(bounty: int, receiver_public_key: str, fees: int):
@@ -194,10 +233,12 @@ def send_bounty(bounty: int, receiver_public_key: str, fees: int):
         logger.debug(transaction)
         logger.info("Wallet: Attempting to Send Transaction")
         try:
-            requests.post(
-                "http://0.0.0.0:" + str(consts.MINER_SERVER_PORT) + "/newtransaction",
-                data=compress(transaction.to_json()),
+            PEER_CLIENT.post(
+                "http://0.0.0.0:" + str(consts.MINER_SERVER_PORT),
+                "/newtransaction",
+                data=transaction.to_payload(consts.WIRE_FORMAT),
                 timeout=(5, 1),
+                retries=0,
             )
         except Exception as e:
             logger.error("Wallet: Could not Send Transaction. Try Again." + str(e))
@@ -208,18 +249,16 @@ def send_bounty(bounty: int, receiver_public_key: str, fees: int):
 def calculate_transaction_fees(tx: Transaction, w: Wallet, bounty: int, fees: int):
     current_amount = 0
     i = 0
-    for so, utxo_list in BLOCKCHAIN.active_chain.utxo.utxo.items():
-        tx_out = utxo_list[0]
-        if utxo_list[2]:
+    for so, utxo_entry in BLOCKCHAIN.active_chain.utxo.unspent_for(w.public_key):
+        if utxo_entry.is_coinbase:
             # check for coinbase TxIn Maturity
-            if not (BLOCKCHAIN.active_chain.length - utxo_list[1].height) >= consts.COINBASE_MATURITY:
+            if not (BLOCKCHAIN.active_chain.length - utxo_entry.height) >= consts.COINBASE_MATURITY:
                 continue
         if current_amount >= bounty + fees:
             break
-        if tx_out.address == w.public_key:
-            current_amount += tx_out.amount
-            tx.vin[i] = TxIn(payout=SingleOutput.from_json(so), pub_key=w.public_key, sig="")
-            i += 1
+        current_amount += utxo_entry.amount
+        tx.vin[i] = TxIn(payout=so, pub_key=w.public_key, sig="")
+        i += 1
     tx.vout[1].amount = current_amount - bounty - fees
     tx.fees = fees
     tx.sign(w)
@@ -254,10 +293,14 @@ def hello():
 
 
 @lru_cache(maxsize=128)
-def cached_get_block(headerhash: str) -> str:
+def cached_get_block(headerhash: str, fmt: str) -> bytes:
     if headerhash:
         db_block = get_block_from_db(headerhash)
         if db_block:
+            if fmt == "binary":
+                return db_block if is_binary(db_block) else Block.from_json(db_block).to_bytes()
+            if is_binary(db_block):
+                return compress(Block.from_bytes(db_block).to_json())
             return compress(db_block)
         else:
             logger.error("ERROR CALLED GETBLOCK FOR NON EXISTENT BLOCK")
@@ -267,62 +310,166 @@ def cached_get_block(headerhash: str) -> str:
 @app.post("/getblock")
 def getblock():
     hhash = request.forms.get("headerhash")
-    return cached_get_block(hhash)
+    fmt = request.forms.get("format", "json")
+    if fmt == "binary":
+        response.content_type = "application/octet-stream"
+    return cached_get_block(hhash, fmt)
 
 
 @app.post("/checkblock")
 def checkblock():
     headerhash = request.forms.get("headerhash")
     response.content_type = "application/json"
-    if headerhash:
-        with Pool(4) as p:
-            hash_list = set(p.map(dhash, BLOCKCHAIN.active_chain.header_list))
-            if headerhash in hash_list:
-                return json.dumps(True)
+    if headerhash and BLOCKCHAIN.active_chain.height_of(headerhash) is not None:
+        return json.dumps(True)
+    return json.dumps(False)
+
+
+@app.post("/merkleproof")
+def merkle_proof():
+    """Proves that a transaction is in a block, a client checks it with MerkleTree.verify_proof against the header"""
+    headerhash = request.forms.get("headerhash")
+    txhash = request.forms.get("txhash")
+    response.content_type = "application/json"
+    db_block = get_block_from_db(headerhash) if headerhash else None
+    if db_block:
+        block = Block.from_payload(db_block)
+        for index, tx in enumerate(block.transactions):
+            if tx.hash == txhash:
+                proof = block.merkle_tree().proof(index)
+                return json.dumps(
+                    {
+                        "merkle_root": block.header.merkle_root,
+                        "index": index,
+                        "proof": [(sibling.hex(), is_right) for sibling, is_right in proof],
+                    }
+                )
     return json.dumps(False)
 
 
 @app.post("/getblockhashes")
 def send_block_hashes():
     peer_height = int(request.forms.get("myheight"))
-    hash_list = []
-    for i in range(peer_height, BLOCKCHAIN.active_chain.length):
-        hash_list.append(dhash(BLOCKCHAIN.active_chain.header_list[i]))
+    hash_list = BLOCKCHAIN.active_chain.hash_list[peer_height:]
     # logger.debug("Server: Sending Peer this Block Hash List: " + str(hash_list))
     return compress(json.dumps(hash_list)).decode()
 
 
+def active_tip_hash() -> Optional[str]:
+    return BLOCKCHAIN.active_chain.header_list[-1].hash if BLOCKCHAIN.active_chain.header_list else None
+
+
+def preempt_miner_if_tip_changed(old_tip: Optional[str]):
+    """Moves the miner over to the new tip, a block that was rejected or only extended a side branch leaves it be"""
+    if active_tip_hash() != old_tip:
+        miner.new_tip()
+        MINING_WAKEUP.set()
+
+
+def connected_since(old_tip: Optional[str]) -> List[str]:
+    """Hashes of the blocks the active chain gained since old_tip was its tip, oldest first, call under the block lock"""
+    old = BLOCKCHAIN.block_index.get(old_tip) if old_tip else None
+    fork = BLOCKCHAIN.find_fork(old) if old is not None else None
+    return [node.hash for node in BLOCKCHAIN.branch(BLOCKCHAIN.best, fork)]
+
+
 @lru_cache(maxsize=16)
 def process_new_block(request_data: bytes) -> str:
     global BLOCKCHAIN
-    block_json = decompress(request_data)
-    if block_json:
+    if request_data:
         try:
-            block = Block.from_json(block_json).object()
+            fields = None
+            # Only the header is decoded until it checks out
+            if is_binary(request_data):
+                header = Block.header_from_bytes(request_data)
+            else:
+                # The json is parsed once, the transactions are only turned into objects if the header passes
+                fields = json.loads(json_from_payload(request_data))
+                header = BlockHeader.from_dict(fields["header"])
             # Check if block already exists
-            if get_block_from_db(dhash(block.header)):
+            if header.hash in BLOCKCHAIN.block_index:
                 logger.info("Server: Received block exists, doing nothing")
                 return "Block already Received Before"
-            if BLOCKCHAIN.add_block(block):
+            if not BLOCKCHAIN.precheck_header(header):
+                logger.info("Server: Received block failed the header checks")
+                return "Invalid Block Received"
+            block = Block.from_payload(request_data) if fields is None else Block.from_dict(fields)
+            # The tip is read under the lock so that only this block's effect on it is seen
+            with BLOCKCHAIN.block_lock:
+                tip = active_tip_hash()
+                added = BLOCKCHAIN.add_block(block)
+                connected = connected_since(tip) if added == AddBlockResult.CONNECTED else []
+            if added == AddBlockResult.CONNECTED:
                 logger.info("Server: Received a New Valid Block, Adding to Chain")
 
-                logger.debug("Server: Sending new block to peers")
-                # Broadcast block to other peers
-                send_to_all_peers("/newblock", request_data)
+                logger.debug("Server: Announcing new blocks to peers")
+                # Only fully validated blocks are relayed, a reorg relays the whole branch it connected
+                for block_hash in connected:
+                    announce_to_all_peers(INV_BLOCK, block_hash)
+            elif added == AddBlockResult.STORED:
+                logger.info("Server: Received a side branch block, stored without relaying it")
 
             # TODO Make new chain/ orphan set for Block that is not added
         except Exception as e:
             logger.error("Server: New Block: invalid block received " + str(e))
             return "Invalid Block Received"
 
-        # Kill Miner
-        t = Timer(1, miner.stop_mining)
-        t.start()
+        preempt_miner_if_tip_changed(tip)
         return "Block Received"
     logger.error("Server: Invalid Block Received")
     return "Invalid Block"
 
 
+def process_mined_block(block: Block):
+    """Takes a block found by our miner straight to the chain, it is already built so there is nothing to decode"""
+    with BLOCKCHAIN.block_lock:
+        tip = active_tip_hash()
+        added = BLOCKCHAIN.add_block(block)
+        connected = connected_since(tip) if added == AddBlockResult.CONNECTED else []
+    if added == AddBlockResult.CONNECTED:
+        logger.info("Server: Mined a New Valid Block, Adding to Chain")
+        for block_hash in connected:
+            announce_to_all_peers(INV_BLOCK, block_hash)
+    else:
+        logger.error("Server: Mined block was not connected to the active chain")
+    preempt_miner_if_tip_changed(tip)
+    # The miner stopped once it found the block, it gets new work right away either way
+    MINING_WAKEUP.set()
+
+
+@app.post("/inv")
+def received_inventory():
+    """A peer announces blocks or transactions by hash, answered with the hashes we want it to send"""
+    response.content_type = "application/json"
+    try:
+        kind = request.forms.get("type")
+        hashes = [str(h) for h in json.loads(request.forms.get("hashes"))[: consts.MAX_INV_SIZE]]
+        peer_url = get_peer_url({"ip": request.remote_addr, "port": request.forms.get("port")})
+    except Exception as e:
+        logger.debug("Server: Inv: Invalid inventory received " + str(e))
+        return json.dumps([])
+    if kind not in (INV_BLOCK, INV_TX):
+        return json.dumps([])
+    # Only known peers are tracked, the port is whatever the client says
+    is_peer = any(get_peer_url(peer) == peer_url for peer in PEER_LIST)
+    if is_peer:
+        # Never announced back to the peer that told us about them
+        BROADCASTER.mark_known(peer_url, kind, hashes)
+    return json.dumps(BROADCASTER.wanted(kind, hashes, peer_url if is_peer else None))
+
+
+@app.post("/getdata")
+def getdata():
+    """Sends a block or transaction a peer asked for by hash, nothing if we do not have it"""
+    item = inventory_payload(request.forms.get("type"), request.forms.get("hash"))
+    if item is None:
+        return b""
+    payload = item[1]
+    if is_binary(payload):
+        response.content_type = "application/octet-stream"
+    return payload
+
+
 @app.post("/newblock")
 def received_new_block():
     print(request)
@@ -332,19 +479,23 @@ def received_new_block():
 @lru_cache(maxsize=16)
 def process_new_transaction(request_data: bytes) -> str:
     global BLOCKCHAIN
-    transaction_json = decompress(request_data)
-    if transaction_json:
+    if request_data:
         try:
-            tx = Transaction.from_json(transaction_json).object()
+            tx = Transaction.from_payload(request_data)
             # Add transaction to Mempool
-            if tx not in BLOCKCHAIN.mempool:
-                if BLOCKCHAIN.active_chain.is_transaction_valid(tx):
-                    logger.debug("Valid Transaction received, Adding to Mempool")
-                    BLOCKCHAIN.mempool.add(tx)
-                    # Broadcast block to other peers
-                    send_to_all_peers("/newtransaction", request_data)
-                else:
-                    return "Transaction Already received"
+            if tx.hash in BLOCKCHAIN.mempool:
+                return "Transaction Already received"
+            # Double spends of a pooled transaction are turned away before their signatures are checked
+            if BLOCKCHAIN.mempool.conflicts(tx):
+                logger.debug("The transaction conflicts with the Mempool, not added to Mempool")
+                return "Not Valid Transaction"
+            if not BLOCKCHAIN.mempool.pays_min_fee(tx):
+                logger.debug("The transaction pays too little fees, not added to Mempool")
+                return "Fees too low"
+            if BLOCKCHAIN.active_chain.is_transaction_valid(tx) and BLOCKCHAIN.mempool.add(tx):
+                logger.debug("Valid Transaction received, Adding to Mempool")
+                # Peers that do not have it yet will ask for it
+                announce_to_all_peers(INV_TX, tx.hash)
             else:
                 logger.debug("The transation is not valid, not added to Mempool")
                 return "Not Valid Transaction"
@@ -361,6 +512,20 @@ def received_new_transaction():
     return process_new_transaction(request.body.read())
 
 
+@app.get("/metrics")
+def metrics():
+    response.content_type = "application/json"
+    return json.dumps(
+        {
+            "miner": miner.metrics.stats(),
+            "mempool": BLOCKCHAIN.mempool.stats(),
+            "signature_cache": SIGNATURE_CACHE.stats(),
+            "peers": PEER_CLIENT.stats(),
+            "broadcast": BROADCASTER.stats(),
+        }
+    )
+
+
 @app.get("/")
 def home():
     return template("home.html")
@@ -407,10 +572,10 @@ def sendinfo():
         "No. of Blocks: "
         + str(BLOCKCHAIN.active_chain.length)
         + "<br>"
-        + dhash(BLOCKCHAIN.active_chain.header_list[-1])
+        + BLOCKCHAIN.active_chain.hash_list[-1]
         + "<br>"
         + "Number of chains "
-        + str(len(BLOCKCHAIN.chains))
+        + str(len(BLOCKCHAIN.tips))
         + "<br>"
         + "Balance "
         + str(check_balance())
@@ -419,6 +584,10 @@ def sendinfo():
         + str(BLOCKCHAIN.active_chain.target_difficulty)
         + "<br>Block reward "
         + str(BLOCKCHAIN.active_chain.current_block_reward())
+        + "<br>Mempool "
+        + str(BLOCKCHAIN.mempool.stats())
+        + "<br>Signature cache "
+        + str(SIGNATURE_CACHE.stats())
         + "<br>Public Key: <br>"
         + str(get_wallet_from_db(consts.MINER_SERVER_PORT)[1])
     )
@@ -432,7 +601,7 @@ def render_block_header(hdr):
     html += "<td>" + str(hdr.height) + "</td></tr>"
 
     html += "<tr><th>" + "Block Hash" + "</th>"
-    html += "<td>" + dhash(hdr) + "</td></tr>"
+    html += "<td>" + hdr.hash + "</td></tr>"
 
     html += "<tr><th>" + "Prev Block Hash" + "</th>"
     html += "<td>" + str(hdr.prev_block_hash) + "</td></tr>"
@@ -453,7 +622,7 @@ def render_block_header(hdr):
     html += "<td>" + str(hdr.nonce) + "</td></tr>"
 
     # get block
-    block = Block.from_json(get_block_from_db(dhash(hdr))).object()
+    block = Block.from_payload(get_block_from_db(hdr.hash))
     
     html += "<tr><th>" + "Transactions" + "</th>"
     html += "<td>" + str(len(block.transactions)) + "</td></tr>"
@@ -470,20 +639,21 @@ def render_block_header(hdr):
 def visualize_chain():
     data = []
     start = BLOCKCHAIN.active_chain.length - 10 if BLOCKCHAIN.active_chain.length > 10 else 0
-    for i, chain in enumerate(BLOCKCHAIN.chains):
+    header_lists = [BLOCKCHAIN.active_chain.header_list] + BLOCKCHAIN.side_branches()
+    for i, header_list in enumerate(header_lists):
         headers = []
         
-        if len(chain.header_list) > 200:
-            for hdr in chain.header_list[:100]:
+        if len(header_list) > 200:
+            for hdr in header_list[:100]:
                 d = {}
-                d["hash"] = dhash(hdr)[-5:]
+                d["hash"] = hdr.hash[-5:]
                 d["time"] = hdr.timestamp
                 d["data"] = render_block_header(hdr)
                 d["height"] = hdr.height
                 headers.append(d)
-        for hdr in chain.header_list[-100:]:
+        for hdr in header_list[-100:]:
             d = {}
-            d["hash"] = dhash(hdr)[-5:]
+            d["hash"] = hdr.hash[-5:]
             d["time"] = hdr.timestamp
             d["data"] = render_block_header(hdr)
             d["height"] = hdr.height
@@ -500,8 +670,9 @@ if __name__ == "__main__":
         else:
             # Restore Blockchain
             logger.info("FullNode: Restoring Existing Chain")
-            header_list = read_header_list_from_db()
-            BLOCKCHAIN.build_from_header_list(header_list)
+            if not BLOCKCHAIN.restore_from_chainstate():
+                header_list = read_header_list_from_db()
+                BLOCKCHAIN.build_from_header_list(header_list)
 
         # Sync with all my peers
         sync_with_peers()
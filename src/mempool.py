@@ -0,0 +1,356 @@
+import time
+from bisect import bisect_left, insort
+from threading import Lock
+from typing import TYPE_CHECKING, Container, Dict, Iterator, List, Optional, Set, Tuple
+
+import utils.constants as consts
+from utils.logger import logger
+from utils.merkle import MerkleTree
+
+if TYPE_CHECKING:
+    from core import Block, Outpoint, SingleOutput, Transaction  # noqa
+
+# (negated fee rate, txid), sorts best fee rate first
+FeeRateKey = Tuple[float, str]
+
+# A template stops looking at the pool after this many transactions in a row did not fit
+MAX_TEMPLATE_MISSES = 1000
+
+# Bytes a transaction takes up in a block's json on top of its own, the ", " separating it from the one before
+TX_SEPARATOR_SIZE = 2
+
+# Stands in for the coinbase, the first leaf of a template's merkle tree, until the miner builds it
+COINBASE_PLACEHOLDER = bytes(32)
+
+
+def spent_outpoint(so: "SingleOutput") -> Optional["Outpoint"]:
+    try:
+        return bytes.fromhex(so.txid), so.vout
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def fee_rate(tx: "Transaction") -> float:
+    """Fees paid per byte of the transaction"""
+    return tx.fees / max(tx.size, 1)
+
+
+def fee_rate_key(tx: "Transaction") -> FeeRateKey:
+    return -fee_rate(tx), tx.hash
+
+
+class BlockTemplate:
+    """The transactions the next block would hold: the pool walked best fee rate first, taking each
+    transaction that still fits in max_size bytes
+
+    The walk is kept as one step per transaction looked at. A change to the pool only drops the steps
+    from the changed transaction's fee rate down, and the walk is resumed from there when the template
+    is next read, so only the part of the template that can have changed is redone. The merkle tree of
+    the taken transactions is cut back and appended to the same way.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # Fee rate key of every transaction looked at, in the order of the pool
+        self.keys: List[FeeRateKey] = []
+        # For each of them whether it was taken, and the size, fees, misses in a row and transactions taken after it
+        self.steps: List[Tuple[bool, int, int, int, int]] = []
+        # Over the coinbase placeholder and the taken transactions
+        self.merkle = MerkleTree([COINBASE_PLACEHOLDER])
+
+    def invalidate(self, key: FeeRateKey):
+        """Drops the steps a transaction with key entering or leaving the pool can change"""
+        i = bisect_left(self.keys, key)
+        del self.keys[i:]
+        del self.steps[i:]
+        self.merkle.truncate(1 + self.count)
+
+    def update(self, by_fee_rate: List[FeeRateKey], txs: Dict[str, "Transaction"]):
+        """Resumes the walk over the pool from where it was left"""
+        taken, size, fees, misses, count = self.steps[-1] if self.steps else (False, 0, 0, 0, 0)
+        start = bisect_left(by_fee_rate, self.keys[-1]) + 1 if self.keys else 0
+        leaves = []
+        for key in by_fee_rate[start:]:
+            if misses >= MAX_TEMPLATE_MISSES:
+                break
+            tx = txs[key[1]]
+            tx_size = tx.size + TX_SEPARATOR_SIZE
+            taken = size + tx_size <= self.max_size
+            if taken:
+                size += tx_size
+                fees += tx.fees
+                misses = 0
+                count += 1
+                leaves.append(bytes.fromhex(tx.hash))
+            else:
+                misses += 1
+            self.keys.append(key)
+            self.steps.append((taken, size, fees, misses, count))
+        self.merkle.extend(leaves)
+
+    def transactions(self, txs: Dict[str, "Transaction"]) -> List["Transaction"]:
+        return [txs[key[1]] for key, step in zip(self.keys, self.steps) if step[0]]
+
+    @property
+    def size(self) -> int:
+        return self.steps[-1][1] if self.steps else 0
+
+    @property
+    def fees(self) -> int:
+        return self.steps[-1][2] if self.steps else 0
+
+    @property
+    def count(self) -> int:
+        return self.steps[-1][4] if self.steps else 0
+
+
+class Mempool:
+    """Transactions waiting to be mined
+
+    Indexed by txid, by the outputs they spend so conflicts are found without a scan, and by fee
+    rate so the best transactions can be read off in order.
+
+    The pool is bounded: past max_size bytes the lowest fee rate transactions are evicted and the
+    minimum fee rate is raised above theirs, decaying back with a half life. Transactions not mined
+    within expiry_secs are dropped.
+    """
+
+    def __init__(
+        self,
+        max_size: int = consts.MAX_MEMPOOL_SIZE_KB * 1024,
+        expiry_secs: int = consts.MEMPOOL_EXPIRY_SECS,
+    ):
+        self.max_size = max_size
+        self.expiry_secs = expiry_secs
+        # Mapping from txid to the transaction
+        self.txs: Dict[str, "Transaction"] = {}
+        # Mapping from every outpoint spent by the pool to the txid spending it
+        self.spent_by: Dict["Outpoint", str] = {}
+        # Fee rate key of every transaction, kept sorted
+        self.by_fee_rate: List[FeeRateKey] = []
+        # Mapping from txid to when it was added, oldest first
+        self.added: Dict[str, float] = {}
+        # Totals over the pool
+        self.total_size = 0
+        self.total_fees = 0
+        # Minimum fee rate raised by evictions and when it was last decayed
+        self.rolling_min_fee_rate = 0.0
+        self.rolling_updated = time.time()
+        self.evicted = 0
+        self.expired = 0
+        # Created by the first call to block_template
+        self.template: Optional[BlockTemplate] = None
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.txs)
+
+    def __contains__(self, txid: str) -> bool:
+        return txid in self.txs
+
+    def get(self, txid: str) -> Optional["Transaction"]:
+        return self.txs.get(txid)
+
+    @staticmethod
+    def inputs(tx: "Transaction") -> Iterator["Outpoint"]:
+        if tx.is_coinbase:
+            return
+        for tx_in in tx.vin.values():
+            outpoint = spent_outpoint(tx_in.payout)
+            if outpoint is not None:
+                yield outpoint
+
+    def conflicts(self, tx: "Transaction") -> Set[str]:
+        """Returns the txids in the pool that spend an output tx also spends"""
+        with self.lock:
+            return {self.spent_by[o] for o in self.inputs(tx) if o in self.spent_by and self.spent_by[o] != tx.hash}
+
+    def min_fee_rate(self) -> float:
+        """The fee rate a transaction must pay to be accepted"""
+        with self.lock:
+            return self._min_fee_rate(time.time())
+
+    def _min_fee_rate(self, now: float) -> float:
+        if self.rolling_min_fee_rate:
+            halvings = (now - self.rolling_updated) / consts.MEMPOOL_MIN_FEE_HALFLIFE_SECS
+            self.rolling_min_fee_rate *= 0.5 ** halvings
+            self.rolling_updated = now
+            # Stop decaying once it no longer matters
+            if self.rolling_min_fee_rate < consts.INCREMENTAL_RELAY_FEE_PER_KB / 1024 / 2:
+                self.rolling_min_fee_rate = 0.0
+        return max(self.rolling_min_fee_rate, consts.MIN_RELAY_FEE_PER_KB / 1024)
+
+    def pays_min_fee(self, tx: "Transaction") -> bool:
+        return fee_rate(tx) >= self.min_fee_rate()
+
+    def add(self, tx: "Transaction") -> bool:
+        """Adds a transaction that is valid against the active chain, evicting the lowest fee rate
+        transactions if the pool grows past its size limit
+
+        Returns:
+            bool -- False if it is already in the pool, spends an output the pool already spends, pays
+                less than the minimum fee rate or was evicted right away
+        """
+        txid = tx.hash
+        outpoints = list(self.inputs(tx))
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            if txid in self.txs:
+                return False
+            if any(o in self.spent_by for o in outpoints):
+                logger.debug("Mempool: Transaction conflicts with one already in the pool")
+                return False
+            if fee_rate(tx) < self._min_fee_rate(now):
+                logger.debug("Mempool: Transaction pays less than the minimum fee rate")
+                return False
+            self.txs[txid] = tx
+            self.added[txid] = now
+            for o in outpoints:
+                self.spent_by[o] = txid
+            key = fee_rate_key(tx)
+            insort(self.by_fee_rate, key)
+            if self.template is not None:
+                self.template.invalidate(key)
+            self.total_size += tx.size
+            self.total_fees += tx.fees
+            self._trim()
+            return txid in self.txs
+
+    def _trim(self):
+        """Evicts the lowest fee rate transactions until the pool fits in max_size"""
+        evicted = 0
+        while self.total_size > self.max_size and self.by_fee_rate:
+            neg_rate, txid = self.by_fee_rate[-1]
+            evicted += self._remove_with_descendants(txid)
+            # Only what pays more than the evicted transaction gets in for a while
+            self.rolling_min_fee_rate = max(self.rolling_min_fee_rate, -neg_rate + consts.INCREMENTAL_RELAY_FEE_PER_KB / 1024)
+            self.rolling_updated = time.time()
+        if evicted:
+            self.evicted += evicted
+            logger.debug(f"Mempool: Full, evicted {evicted} transactions")
+
+    def expire(self) -> int:
+        """Drops the transactions that have been in the pool longer than expiry_secs
+
+        Returns:
+            int -- The number of transactions dropped
+        """
+        with self.lock:
+            return self._expire(time.time())
+
+    def _expire(self, now: float) -> int:
+        cutoff = now - self.expiry_secs
+        stale = []
+        for txid, added in self.added.items():
+            if added > cutoff:
+                break
+            stale.append(txid)
+        removed = sum(self._remove_with_descendants(txid) for txid in stale)
+        if removed:
+            self.expired += removed
+            logger.debug(f"Mempool: {removed} transactions expired")
+        return removed
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "transactions": len(self.txs),
+                "size": self.total_size,
+                "max_size": self.max_size,
+                "min_fee_per_kb": self._min_fee_rate(time.time()) * 1024,
+                "evicted": self.evicted,
+                "expired": self.expired,
+            }
+
+    def remove(self, txid: str) -> Optional["Transaction"]:
+        with self.lock:
+            return self._remove(txid)
+
+    def _remove(self, txid: str) -> Optional["Transaction"]:
+        tx = self.txs.pop(txid, None)
+        if tx is None:
+            return None
+        del self.added[txid]
+        for o in self.inputs(tx):
+            if self.spent_by.get(o) == txid:
+                del self.spent_by[o]
+        key = fee_rate_key(tx)
+        i = bisect_left(self.by_fee_rate, key)
+        if i < len(self.by_fee_rate) and self.by_fee_rate[i] == key:
+            del self.by_fee_rate[i]
+        if self.template is not None:
+            self.template.invalidate(key)
+        self.total_size -= tx.size
+        self.total_fees -= tx.fees
+        return tx
+
+    def _remove_with_descendants(self, txid: str) -> int:
+        """Removes a transaction and every transaction in the pool spending its outputs"""
+        removed = 0
+        pending = [txid]
+        while pending:
+            tx = self._remove(pending.pop())
+            if tx is None:
+                continue
+            removed += 1
+            txid_bytes = bytes.fromhex(tx.hash)
+            for vout in tx.vout:
+                child = self.spent_by.get((txid_bytes, vout))
+                if child is not None:
+                    pending.append(child)
+        return removed
+
+    def remove_block_transactions(self, block: "Block") -> int:
+        """Removes the transactions of a block that was connected to the active chain, and those conflicting
+        with them, in time proportional to the size of the block
+
+        Returns:
+            int -- The number of transactions removed
+        """
+        removed = 0
+        with self.lock:
+            for tx in block.transactions:
+                if self._remove(tx.hash) is not None:
+                    removed += 1
+                # Whatever still spends one of its inputs is a double spend now
+                for o in self.inputs(tx):
+                    spender = self.spent_by.get(o)
+                    if spender is not None:
+                        removed += self._remove_with_descendants(spender)
+        if removed:
+            logger.debug(f"Mempool: Removed {removed} transactions for block {block.header.hash}")
+        return removed
+
+    def remove_missing_inputs(self, unspent: Container["Outpoint"]) -> int:
+        """Removes the transactions spending an outpoint that is not in unspent and those spending their
+        outputs, for when the active chain moved to another branch
+
+        Returns:
+            int -- The number of transactions removed
+        """
+        with self.lock:
+            stale = [txid for txid, tx in self.txs.items() if any(o not in unspent for o in self.inputs(tx))]
+            return sum(self._remove_with_descendants(txid) for txid in stale)
+
+    def best_transactions(self, limit: Optional[int] = None) -> List["Transaction"]:
+        """Returns up to limit transactions, highest fee rate first, without sorting the pool"""
+        with self.lock:
+            keys = self.by_fee_rate if limit is None else self.by_fee_rate[:limit]
+            return [self.txs[txid] for _, txid in keys]
+
+    def block_template(self, max_size: int) -> Tuple[List["Transaction"], int, int, MerkleTree]:
+        """Returns the transactions for the next block, best fee rate first, within max_size bytes of block json
+
+        Returns:
+            List[Transaction] -- The transactions
+            int -- Their fees
+            int -- Their size, counting the separator before each
+            MerkleTree -- A copy of the tree over them, with COINBASE_PLACEHOLDER as the first leaf
+        """
+        with self.lock:
+            if self.template is None or self.template.max_size != max_size:
+                self.template = BlockTemplate(max_size)
+            self.template.update(self.by_fee_rate, self.txs)
+            template = self.template
+            return template.transactions(self.txs), template.fees, template.size, template.merkle.copy()
@@ -1,79 +1,280 @@
-import copy
-import sys
 import time
-from multiprocessing import Process
-from operator import attrgetter
+from collections import deque
+from dataclasses import dataclass
+from hashlib import sha256
+from multiprocessing import Process, Queue, RawArray, RawValue
+from queue import Empty
+from statistics import mean
 from sys import getsizeof
-from typing import List, Optional, Set, Tuple
+from threading import Lock, Thread
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
 
 import requests
 
 import utils.constants as consts
-from core import Block, BlockHeader, Chain, Transaction, TxIn, TxOut
+from core import Block, BlockHeader, Chain, Transaction, TxIn, TxOut, target_for
+from mempool import Mempool
 from utils.logger import logger
-from utils.utils import compress, dhash, merkle_hash
+from utils.merkle import MerkleTree
+
+# Nonces a worker tries between looking at the current job
+STOP_CHECK_INTERVAL = 2 ** 12
+
+NONCE_SPACE = 2 ** 64
+
+# Job id meaning there is nothing to mine
+NO_JOB = 0
+
+
+@dataclass
+class WorkUnit:
+    """ All a mining worker gets of a block template, a few hundred bytes however big the chain or mempool """
+
+    # Increases with every template, a worker drops a unit once the current job moves past it
+    job_id: int
+
+    # BlockHeader.hash_prefix() of the header being mined
+    prefix: bytes
+
+    # target_for() its target difficulty
+    target: int
+
+    # The nonces [start, end) this worker tries
+    start: int
+    end: int
+
+    # Index of the worker, its slot in MinerStats.hashes
+    worker: int = 0
+
+
+class MinerStats:
+    """ Rolling measurements of the miner, for /metrics and the periodic log summary """
+
+    def __init__(self, workers: int, window: int = consts.MINER_STATS_WINDOW):
+        # Hashes tried by each worker, written by the workers themselves
+        self.hashes = RawArray("Q", workers)
+        # (time, hashes) snapshots the hash rates are measured between
+        self.samples: Deque[Tuple[float, List[int]]] = deque(maxlen=window)
+        # Seconds from handing out a template to its block being found
+        self.find_secs: Deque[float] = deque(maxlen=window)
+        # Seconds taken to build a template
+        self.template_secs: Deque[float] = deque(maxlen=window)
+        # Seconds from the tip changing to start_mining being called for the new tip, the node's mining gate
+        self.tip_to_start_secs: Deque[float] = deque(maxlen=window)
+        # Seconds from start_mining being called for the new tip to work on it being handed out
+        self.tip_to_work_secs: Deque[float] = deque(maxlen=window)
+        self.blocks_found = 0
+        # Templates dropped before a block was found on them
+        self.stale_templates = 0
+        self.tip_changed_at: Optional[float] = None
+        self.lock = Lock()
+
+    def sample(self):
+        with self.lock:
+            self.samples.append((time.time(), list(self.hashes)))
+
+    def hash_rates(self) -> List[float]:
+        """Hashes per second of each worker between the oldest and newest sample"""
+        with self.lock:
+            if len(self.samples) < 2:
+                return [0.0] * len(self.hashes)
+            (t0, first), (t1, last) = self.samples[0], self.samples[-1]
+        return [(b - a) / (t1 - t0) if t1 > t0 else 0.0 for a, b in zip(first, last)]
+
+    def record(self, series: Deque[float], secs: float):
+        with self.lock:
+            series.append(secs)
+
+    def stats(self) -> Dict[str, Any]:
+        rates = self.hash_rates()
+        with self.lock:
+            return {
+                "hash_rate": sum(rates),
+                "hash_rate_per_worker": rates,
+                "blocks_found": self.blocks_found,
+                "avg_find_secs": mean(self.find_secs) if self.find_secs else None,
+                "avg_template_ms": mean(self.template_secs) * 1000 if self.template_secs else None,
+                "avg_tip_to_start_ms": mean(self.tip_to_start_secs) * 1000 if self.tip_to_start_secs else None,
+                "avg_tip_to_work_ms": mean(self.tip_to_work_secs) * 1000 if self.tip_to_work_secs else None,
+                "stale_templates": self.stale_templates,
+            }
+
+    def summary(self) -> str:
+        s = self.stats()
+
+        def fmt(value, unit):
+            return "-" if value is None else f"{value:.2f}{unit}"
+
+        return (
+            f"Miner: {s['hash_rate'] / 1e3:.1f} kH/s over {len(s['hash_rate_per_worker'])} workers, "
+            f"{s['blocks_found']} blocks found in {fmt(s['avg_find_secs'], 's')} avg, "
+            f"template {fmt(s['avg_template_ms'], 'ms')}, tip to start {fmt(s['avg_tip_to_start_ms'], 'ms')}, "
+            f"tip to work {fmt(s['avg_tip_to_work_ms'], 'ms')}, "
+            f"{s['stale_templates']} stale templates"
+        )
+
+
+def search_nonces(work: WorkUnit, current_job, hashes=None) -> Optional[int]:
+    """Tries the nonces of work until one meets the target or current_job moves on from it
+
+    Adds the number of nonces tried to hashes[work.worker] as it goes, if given.
+
+    Returns:
+        Optional[int] -- The winning nonce, None if the unit was dropped or its nonces ran out
+    """
+    # sha256 state after the fixed part of the header, only the nonce is hashed per attempt
+    copy_midstate = sha256(work.prefix).copy
+    # Both are 32 bytes big endian, comparing them is comparing the numbers
+    target_bytes = min(work.target, 2 ** 256 - 1).to_bytes(32, "big")
+    for base in range(work.start, work.end, STOP_CHECK_INTERVAL):
+        if current_job.value != work.job_id:
+            return None
+        top = min(base + STOP_CHECK_INTERVAL, work.end)
+        for n in range(base, top):
+            h = copy_midstate()
+            h.update(b"%d)" % n)
+            if sha256(h.digest()).digest() < target_bytes:
+                return n
+        if hashes is not None:
+            hashes[work.worker] += top - base
+    return None
+
+
+def mining_worker(jobs: Queue, results: Queue, current_job, hashes):
+    """Runs for the life of the node, searching the newest work unit sent on jobs and putting (job id, nonce) on results
+
+    A nonce of None means the unit's nonces ran out. Nothing is reported for a unit that was dropped.
+    """
+    while True:
+        work = jobs.get()
+        # Only the newest unit can still be current
+        try:
+            while True:
+                work = jobs.get_nowait()
+        except Empty:
+            pass
+        if work.job_id != current_job.value:
+            continue
+        nonce = search_nonces(work, current_job, hashes)
+        if work.job_id == current_job.value:
+            results.put((work.job_id, nonce))
 
 
 class Miner:
-    def __init__(self):
-        self.p: Optional[Process] = None
+    """Mines on long lived worker processes
+
+    The node process builds the block and keeps it, the workers only get a WorkUnit each over their
+    own queue. Setting current_job to a new id, or to NO_JOB, makes them drop what they are working on
+    at their next check, so new work takes over without restarting anything.
+    """
+
+    def __init__(self, workers: int = consts.MINING_WORKERS, on_block: Optional[Callable[[Block], None]] = None):
+        # Number of processes the nonce space is split across
+        self.workers = max(workers, 1)
+        # Takes a mined block to the node, blocks are posted to its /newblock if not given
+        self.on_block = on_block
+        # Shared with the workers, the job they should be working on
+        self.current_job = RawValue("q", NO_JOB)
+        self.job_id = NO_JOB
+        # The block being mined and what it pays
+        self.block: Optional[Block] = None
+        self.reward = 0
+        # Workers that ran out of nonces on the current job
+        self.exhausted = 0
+        self.job_started_at = 0.0
+        self.metrics = MinerStats(self.workers)
+        self.job_queues: List[Queue] = []
+        self.results: Optional[Queue] = None
+        self.procs: List[Process] = []
+        self.lock = Lock()
+
+    def start_workers(self):
+        if self.procs:
+            return
+        self.results = Queue()
+        for _ in range(self.workers):
+            jobs: Queue = Queue()
+            p = Process(target=mining_worker, args=(jobs, self.results, self.current_job, self.metrics.hashes), daemon=True)
+            p.start()
+            self.job_queues.append(jobs)
+            self.procs.append(p)
+        Thread(target=self.collect_results, name="MinerResults", daemon=True).start()
 
     def is_mining(self):
-        if self.p:
-            if self.p.is_alive():
-                return True
-            else:
-                self.p = None
-        return False
-
-    def start_mining(self, mempool: Set[Transaction], chain: Chain, payout_addr: str):
-        if not self.is_mining():
-            self.p = Process(target=self.__mine, args=(mempool, chain, payout_addr))
-            self.p.start()
-            # logger.debug("Started mining")
+        return self.current_job.value != NO_JOB
+
+    def start_mining(self, mempool: Mempool, chain: Chain, payout_addr: str):
+        called_at = time.time()
+        with self.lock:
+            if self.is_mining():
+                return
+            self.start_workers()
+            tss = time.perf_counter()
+            transactions, fees, _, merkle = mempool.block_template(self.block_size_limit(chain, payout_addr))
+            block = self.build_block(transactions, fees, chain, payout_addr, merkle)
+            self.block = block
+            self.reward = chain.current_block_reward()
+            self.exhausted = 0
+            self.job_id += 1
+            prefix = block.header.hash_prefix()
+            target = target_for(block.header.target_difficulty)
+            chunk = NONCE_SPACE // self.workers
+            self.current_job.value = self.job_id
+            for i, jobs in enumerate(self.job_queues):
+                end = NONCE_SPACE if i == self.workers - 1 else (i + 1) * chunk
+                jobs.put(WorkUnit(job_id=self.job_id, prefix=prefix, target=target, start=i * chunk, end=end, worker=i))
+            self.metrics.record(self.metrics.template_secs, time.perf_counter() - tss)
+            self.job_started_at = time.time()
+            if self.metrics.tip_changed_at is not None:
+                # Split so the wait the node chose to make before mining does not read as handoff latency
+                self.metrics.record(self.metrics.tip_to_start_secs, called_at - self.metrics.tip_changed_at)
+                self.metrics.record(self.metrics.tip_to_work_secs, self.job_started_at - called_at)
+                self.metrics.tip_changed_at = None
+            # logger.debug(f"Miner: Will mine {len(transactions)} transactions and get {fees} scoins in fees")
 
     def stop_mining(self):
-        if self.is_mining():
+        with self.lock:
             # logger.debug("Miner: Called Stop Mining")
-            self.p.terminate()
-            self.p = None
-
-    def calculate_transaction_fees_and_size(self, transactions: List[Transaction]) -> Tuple[int, int]:
-        transactions.sort(key=attrgetter("fees"), reverse=True)
-        size = 0
-        fees = 0
-        for t in transactions:
-            size += sys.getsizeof(t.to_json())
-            fees += t.fees
-        return fees, size
-
-    def __calculate_best_transactions(self, transactions: List[Transaction]) -> Tuple[List[Transaction], int]:
-        """Returns the best transactions to be mined which don't exceed the max block size
-        
-        Arguments:
-            transactions {List[Transaction]} -- The transactions to be mined
-        
-        Returns:
-            List[Transaction] -- the transactions which give the best fees
-            int -- The fees in scoins
+            if self.is_mining():
+                self.metrics.stale_templates += 1
+            # The workers drop the job at their next check
+            self.current_job.value = NO_JOB
+            self.block = None
+
+    def new_tip(self):
+        """Stops mining on the old tip, the time until mining is started on the new one and until its work is handed out are measured"""
+        self.metrics.tip_changed_at = time.time()
+        self.stop_mining()
+
+    def collect_results(self):
+        while True:
+            job_id, nonce = self.results.get()
+            with self.lock:
+                if job_id != self.current_job.value:
+                    continue
+                if nonce is None:
+                    self.exhausted += 1
+                    if self.exhausted == self.workers:
+                        logger.error("Miner: Exhausted all 2 ** 64 values without finding proper hash")
+                        self.current_job.value = NO_JOB
+                    continue
+                block = self.block
+                block.header.nonce = nonce
+                reward = self.reward
+                self.current_job.value = NO_JOB
+                self.metrics.blocks_found += 1
+                self.metrics.record(self.metrics.find_secs, time.time() - self.job_started_at)
+            self.submit(block, reward)
+
+    @staticmethod
+    def build_block(
+        transactions: List[Transaction], fees: int, chain: Chain, payout_addr: str, merkle: Optional[MerkleTree] = None
+    ) -> Block:
+        """Returns the block to be mined on top of chain, with a coinbase paying payout_addr and a nonce of 0
+
+        merkle is the template's tree over a coinbase placeholder and transactions, only its first leaf is
+        replaced. Without it the tree is built from scratch.
         """
-        transactions.sort(key=attrgetter("fees"), reverse=True)
-        size = 0
-        fees = 0
-        mlist = []
-        for t in transactions:
-            if size < consts.MAX_BLOCK_SIZE_KB:
-                mlist.append(t)
-                size += getsizeof(t.to_json())
-                fees += t.fees
-            else:
-                break
-        return mlist, fees
-
-    def __mine(self, mempool: Set[Transaction], chain: Chain, payout_addr: str) -> Block:
-        c_pool = list(copy.deepcopy(mempool))
-        mlist, fees = self.__calculate_best_transactions(c_pool)
-        # logger.debug(f"Miner: Will mine {len(mlist)} transactions and get {fees} scoins in fees")
         coinbase_tx_in = {0: TxIn(payout=None, sig="Receiving some Money", pub_key="Does it matter?")}
         coinbase_tx_out = {
             0: TxOut(amount=chain.current_block_reward(), address=payout_addr),
@@ -88,27 +289,33 @@ class Miner:
             vin=coinbase_tx_in,
             vout=coinbase_tx_out,
         )
-        mlist.insert(0, coinbase_tx)
+        mlist = [coinbase_tx] + transactions
+        if merkle is None:
+            merkle = MerkleTree.from_transactions(mlist)
+        else:
+            merkle.update(0, bytes.fromhex(coinbase_tx.hash))
         block_header = BlockHeader(
             version=consts.MINER_VERSION,
             height=chain.length,
-            prev_block_hash=dhash(chain.header_list[-1]),
-            merkle_root=merkle_hash(mlist),
+            prev_block_hash=chain.hash_list[-1],
+            merkle_root=merkle.root_hex(),
             timestamp=int(time.time()),
             target_difficulty=chain.target_difficulty,
             nonce=0,
         )
-        DONE = False
-        for n in range(2 ** 64):
-            block_header.nonce = n
-            bhash = dhash(block_header)
-            if chain.is_proper_difficulty(bhash):
-                block = Block(header=block_header, transactions=mlist)
-                requests.post("http://0.0.0.0:" + str(consts.MINER_SERVER_PORT) + "/newblock", data=compress(block.to_json()))
-                logger.info(
-                    f"Miner: Mined Block with {len(mlist)} transactions, Got {fees} in fees and {chain.current_block_reward()} as reward"
-                )
-                DONE = True
-                break
-        if not DONE:
-            logger.error("Miner: Exhausted all 2 ** 64 values without finding proper hash")
+        return Block(header=block_header, transactions=mlist)
+
+    def block_size_limit(self, chain: Chain, payout_addr: str) -> int:
+        """Returns the bytes of block json left for transactions besides the coinbase, measured the way Block.is_valid does"""
+        # The largest the coinbase fees and the nonce can get
+        block = self.build_block([], consts.MAX_SCOINS_POSSIBLE, chain, payout_addr)
+        block.header.nonce = NONCE_SPACE - 1
+        return consts.MAX_BLOCK_SIZE_KB * 1024 - getsizeof(block.to_json())
+
+    def submit(self, block: Block, reward: int):
+        if self.on_block is not None:
+            self.on_block(block)
+        else:
+            requests.post("http://0.0.0.0:" + str(consts.MINER_SERVER_PORT) + "/newblock", data=block.to_payload(consts.WIRE_FORMAT))
+        fees = block.transactions[0].vout[1].amount
+        logger.info(f"Miner: Mined Block with {len(block.transactions)} transactions, Got {fees} in fees and {reward} as reward")
@@ -0,0 +1,125 @@
+import os
+import time
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import utils.constants as consts
+from utils.logger import logger
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+class PeerStats:
+    """ Requests made to one peer and how they went """
+
+    __slots__ = ("requests", "errors", "retries", "total_latency", "last_error")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        # Seconds spent on requests that got a response
+        self.total_latency = 0.0
+        self.last_error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        answered = self.requests - self.errors
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "avg_latency_ms": self.total_latency / answered * 1000 if answered else None,
+            "last_error": self.last_error,
+        }
+
+
+class PeerClient:
+    """HTTP client for all traffic to peers, keeping a pool of keep-alive connections per peer
+
+    Connection errors and timeouts are retried with exponential backoff. The pools are dropped in a
+    forked child, which must not share the parent's sockets.
+    """
+
+    def __init__(
+        self,
+        timeout: Timeout = (consts.PEER_CONNECT_TIMEOUT, consts.PEER_READ_TIMEOUT),
+        retries: int = consts.PEER_RETRIES,
+        backoff: float = consts.PEER_RETRY_BACKOFF_SECS,
+        pool_size: int = consts.PEER_POOL_SIZE,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        # Mapping from peer base url to its session and stats
+        self.sessions: Dict[str, requests.Session] = {}
+        self.peer_stats: Dict[str, PeerStats] = {}
+        self.pid = os.getpid()
+        self.lock = Lock()
+
+    def session(self, base_url: str) -> Tuple[requests.Session, PeerStats]:
+        with self.lock:
+            if self.pid != os.getpid():
+                self.sessions = {}
+                self.peer_stats = {}
+                self.pid = os.getpid()
+            session = self.sessions.get(base_url)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[base_url] = session
+                self.peer_stats[base_url] = PeerStats()
+            return session, self.peer_stats[base_url]
+
+    def post(
+        self, base_url: str, path: str = "", data: Any = None, timeout: Optional[Timeout] = None, retries: Optional[int] = None
+    ) -> requests.Response:
+        """Posts data to base_url + path over the peer's pool
+
+        Raises:
+            requests.RequestException -- If the last attempt failed too
+        """
+        session, stats = self.session(base_url)
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            tss = time.perf_counter()
+            with self.lock:
+                stats.requests += 1
+            try:
+                r = session.post(base_url + path, data=data, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                with self.lock:
+                    stats.errors += 1
+                    stats.last_error = str(e)
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                with self.lock:
+                    stats.retries += 1
+                delay = self.backoff * 2 ** (attempt - 1)
+                logger.debug(f"PeerClient: {base_url}{path} failed, retry {attempt} in {delay:.2f} secs")
+                time.sleep(delay)
+                continue
+            with self.lock:
+                stats.total_latency += time.perf_counter() - tss
+            return r
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            return {base_url: stats.to_dict() for base_url, stats in self.peer_stats.items()}
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+PEER_CLIENT = PeerClient()
@@ -0,0 +1,117 @@
+"""
+Only blocks connected to the active chain are relayed or served to peers.
+Run from src/ with `python -m pytest test_gossip.py`.
+"""
+
+import os
+import sys
+import time
+
+# utils.constants parses the command line on import, pytest's own arguments are not for it
+sys.argv = sys.argv[:1]
+
+import pytest  # noqa: E402
+
+import core  # noqa: E402
+import fullnode  # noqa: E402
+import utils.constants as consts  # noqa: E402
+import utils.storage as storage  # noqa: E402
+from broadcaster import INV_BLOCK  # noqa: E402
+from core import AddBlockResult, Block, BlockChain, BlockHeader, Transaction, TxIn, TxOut, genesis_block  # noqa: E402
+from utils.merkle import MerkleTree  # noqa: E402
+
+# Blocks this far apart make the chain retarget well above the initial difficulty
+BLOCK_SPACING_SECS = 1
+CHAIN_LENGTH = 12
+
+
+def make_block(parent: BlockHeader, target_difficulty: int, reward: int, timestamp: int, address: str = "main") -> Block:
+    coinbase = Transaction(
+        is_coinbase=True,
+        version=consts.MINER_VERSION,
+        fees=0,
+        timestamp=timestamp,
+        locktime=-1,
+        vin={0: TxIn(payout=None, sig="Receiving some Money", pub_key="Does it matter?")},
+        vout={0: TxOut(amount=reward, address=address), 1: TxOut(amount=0, address=address)},
+    )
+    header = BlockHeader(
+        version=consts.MINER_VERSION,
+        height=parent.height + 1,
+        prev_block_hash=parent.hash,
+        merkle_root=MerkleTree.from_transactions([coinbase]).root_hex(),
+        timestamp=timestamp,
+        target_difficulty=target_difficulty,
+        nonce=0,
+    )
+    return Block(header=header, transactions=[coinbase])
+
+
+@pytest.fixture
+def node(monkeypatch, tmp_path):
+    """A node whose chain has retargeted past the initial difficulty, with announcements recorded instead of sent"""
+    for name in ("BLOCK_DB_LOC", "CHAIN_DB_LOC", "CHAINSTATE_DB_LOC"):
+        loc = str(tmp_path / os.path.basename(getattr(consts, name)))
+        monkeypatch.setattr(consts, name, loc)
+        monkeypatch.setattr(storage, name, loc)
+    monkeypatch.setattr(storage, "DB_FORMAT", "binary")
+    # The blocks are not mined, every hash passes
+    monkeypatch.setattr(core, "meets_target_difficulty", lambda bhash, target_difficulty: True)
+
+    blockchain = BlockChain()
+    blockchain.add_block(genesis_block)
+    timestamp = int(time.time()) - CHAIN_LENGTH * BLOCK_SPACING_SECS
+    for _ in range(CHAIN_LENGTH):
+        chain = blockchain.active_chain
+        timestamp += BLOCK_SPACING_SECS
+        block = make_block(chain.header_list[-1], chain.target_difficulty, chain.current_block_reward(), timestamp)
+        assert blockchain.add_block(block) == AddBlockResult.CONNECTED
+    assert blockchain.active_chain.target_difficulty > consts.INITIAL_BLOCK_DIFFICULTY
+
+    announced = []
+    monkeypatch.setattr(fullnode, "BLOCKCHAIN", blockchain)
+    monkeypatch.setattr(fullnode, "PEER_LIST", [{"ip": "127.0.0.1", "port": 9999}])
+    monkeypatch.setattr(fullnode.BROADCASTER, "announce", lambda base_urls, kind, item_hash: announced.append((kind, item_hash)))
+    monkeypatch.setattr(fullnode.miner, "new_tip", lambda: None)
+    fullnode.process_new_block.cache_clear()
+    fullnode.cached_get_block.cache_clear()
+    return blockchain, announced
+
+
+def test_low_difficulty_side_block_is_not_announced(node):
+    blockchain, announced = node
+    chain = blockchain.active_chain
+    parent = chain.header_list[-3]
+    block = make_block(parent, consts.INITIAL_BLOCK_DIFFICULTY, chain.current_block_reward(), parent.timestamp + 1, "side")
+    tip = fullnode.active_tip_hash()
+
+    assert fullnode.process_new_block(block.to_payload(consts.WIRE_FORMAT)) == "Invalid Block Received"
+    assert block.header.hash not in blockchain.block_index
+    assert fullnode.active_tip_hash() == tip
+    assert announced == []
+    assert fullnode.inventory_payload(INV_BLOCK, block.header.hash) is None
+
+
+def test_side_block_is_stored_but_not_announced_or_served(node):
+    blockchain, announced = node
+    chain = blockchain.active_chain
+    parent = chain.header_list[-3]
+    target = blockchain.block_index[parent.hash].next_target_difficulty
+    block = make_block(parent, target, chain.current_block_reward(), parent.timestamp + 1, "side")
+
+    assert fullnode.process_new_block(block.to_payload(consts.WIRE_FORMAT)) == "Block Received"
+    assert block.header.hash in blockchain.block_index
+    assert announced == []
+    assert fullnode.inventory_payload(INV_BLOCK, block.header.hash) is None
+
+
+def test_connected_block_is_announced_and_served(node):
+    blockchain, announced = node
+    chain = blockchain.active_chain
+    parent = chain.header_list[-1]
+    block = make_block(parent, chain.target_difficulty, chain.current_block_reward(), parent.timestamp + 1)
+
+    assert fullnode.process_new_block(block.to_payload(consts.WIRE_FORMAT)) == "Block Received"
+    assert fullnode.active_tip_hash() == block.header.hash
+    assert announced == [(INV_BLOCK, block.header.hash)]
+    assert fullnode.inventory_payload(INV_BLOCK, block.header.hash) is not None
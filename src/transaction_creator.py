@@ -1,4 +1,3 @@
-import copy
 import json
 from typing import Any, Dict
 
@@ -8,7 +7,6 @@ from block_creator import first_block_transaction
 from core import SingleOutput, Transaction, TxIn, TxOut
 from utils import constants as consts
 from utils.logger import logger
-from utils.utils import dhash
 from wallet import Wallet
 
 
@@ -25,7 +23,7 @@ def get_peer_url(peer: Dict[str, Any]) -> str:
 if __name__ == "__main__":
 
     # The singleOutput for first coinbase transaction in genesis block
-    so = SingleOutput(txid=dhash(first_block_transaction[0]), vout=0)
+    so = SingleOutput(txid=first_block_transaction[0].hash, vout=0)
 
     first_transaction = Transaction(
         version=1,
@@ -37,13 +35,10 @@ if __name__ == "__main__":
         vout={0: TxOut(amount=1000000000, address=consts.WALLET_PUBLIC)},
     )
 
-    sign_copy_of_tx = copy.deepcopy(first_transaction)
-    sign_copy_of_tx.vin = {}
     w = Wallet()
     w.public_key = consts.WALLET_PUBLIC
     w.private_key = consts.WALLET_PRIVATE
-    sig = w.sign(sign_copy_of_tx.to_json())
-    first_transaction.vin[0].sig = sig
+    first_transaction.sign(w)
 
     peer_list = fetch_peer_list()
     print(peer_list)
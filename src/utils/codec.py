@@ -0,0 +1,275 @@
+import binascii
+import json
+import struct
+from abc import ABC, abstractmethod
+from typing import Any, Optional, Union
+
+from .utils import compress, decompress
+
+# Every binary payload starts with this, it can never start a json or a base85 string
+MAGIC = b"\x00sc"
+CODEC_VERSION = 1
+
+_FRAME = struct.Struct(">3sBBI")
+_U8 = struct.Struct(">B")
+_U32 = struct.Struct(">I")
+_I64 = struct.Struct(">q")
+_U64 = struct.Struct(">Q")
+_F64 = struct.Struct(">d")
+
+# Tags for scalar values
+VALUE_NONE = 0
+VALUE_FALSE = 1
+VALUE_TRUE = 2
+VALUE_INT = 3
+VALUE_UINT = 4
+VALUE_FLOAT = 5
+VALUE_TEXT = 6
+
+# Tags for strings, picked so that decoding gives back the exact same string
+TEXT_NONE = 0
+TEXT_HASH = 1  # 64 char lowercase hex, stored as 32 raw bytes
+TEXT_HEX = 2  # Any other lowercase hex string
+TEXT_BASE64 = 3  # Canonical base64, used for encoded public keys
+TEXT_SIG = 4  # "[r, s]" signature from Wallet.sign, stored as 64 raw bytes
+TEXT_UTF8 = 5
+
+
+def is_binary(payload: Union[str, bytes]) -> bool:
+    return isinstance(payload, (bytes, bytearray, memoryview)) and bytes(payload[: len(MAGIC)]) == MAGIC
+
+
+def json_from_payload(payload: Union[str, bytes]) -> str:
+    """Returns the json of a compressed json payload or a plain json string"""
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode()
+    if not payload.startswith("{"):
+        payload = decompress(payload)
+    return payload
+
+
+class Writer:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def getvalue(self) -> bytes:
+        return bytes(self.buf)
+
+    def u8(self, v: int):
+        self.buf += _U8.pack(v)
+
+    def u32(self, v: int):
+        self.buf += _U32.pack(v)
+
+    def raw(self, data: bytes):
+        self.buf += data
+
+    def blob(self, data: bytes):
+        self.buf += _U32.pack(len(data))
+        self.buf += data
+
+    def value(self, v: Any):
+        if v is None:
+            self.u8(VALUE_NONE)
+        elif v is True:
+            self.u8(VALUE_TRUE)
+        elif v is False:
+            self.u8(VALUE_FALSE)
+        elif isinstance(v, int):
+            if -(2 ** 63) <= v < 2 ** 63:
+                self.u8(VALUE_INT)
+                self.buf += _I64.pack(v)
+            else:
+                self.u8(VALUE_UINT)
+                self.buf += _U64.pack(v)
+        elif isinstance(v, float):
+            self.u8(VALUE_FLOAT)
+            self.buf += _F64.pack(v)
+        elif isinstance(v, str):
+            self.u8(VALUE_TEXT)
+            self.text(v)
+        else:
+            raise ValueError(f"Codec: Cannot encode value of type {type(v)}")
+
+    def text(self, s: Optional[str]):
+        if s is None:
+            self.u8(TEXT_NONE)
+            return
+        if s[:1] == "[":
+            sig = _sig_to_bytes(s)
+            if sig is not None:
+                self.u8(TEXT_SIG)
+                self.buf += sig
+                return
+        raw = _hex_to_bytes(s)
+        if raw is not None:
+            if len(raw) == 32:
+                self.u8(TEXT_HASH)
+                self.buf += raw
+            else:
+                self.u8(TEXT_HEX)
+                self.blob(raw)
+            return
+        raw = _base64_to_bytes(s)
+        if raw is not None:
+            self.u8(TEXT_BASE64)
+            self.blob(raw)
+            return
+        self.u8(TEXT_UTF8)
+        self.blob(s.encode())
+
+
+class Reader:
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def _take(self, n: int) -> memoryview:
+        end = self.pos + n
+        if end > len(self.data):
+            raise ValueError("Codec: Payload truncated")
+        chunk = self.data[self.pos : end]
+        self.pos = end
+        return chunk
+
+    def done(self):
+        if self.pos != len(self.data):
+            raise ValueError("Codec: Trailing bytes in payload")
+
+    def u8(self) -> int:
+        return self._take(1)[0]
+
+    def u32(self) -> int:
+        return _U32.unpack(self._take(4))[0]
+
+    def raw(self, n: int) -> bytes:
+        return bytes(self._take(n))
+
+    def blob(self) -> bytes:
+        return bytes(self._take(self.u32()))
+
+    def value(self) -> Any:
+        tag = self.u8()
+        if tag == VALUE_NONE:
+            return None
+        if tag == VALUE_FALSE:
+            return False
+        if tag == VALUE_TRUE:
+            return True
+        if tag == VALUE_INT:
+            return _I64.unpack(self._take(8))[0]
+        if tag == VALUE_UINT:
+            return _U64.unpack(self._take(8))[0]
+        if tag == VALUE_FLOAT:
+            return _F64.unpack(self._take(8))[0]
+        if tag == VALUE_TEXT:
+            return self.text()
+        raise ValueError(f"Codec: Unknown value tag {tag}")
+
+    def text(self) -> Optional[str]:
+        tag = self.u8()
+        if tag == TEXT_NONE:
+            return None
+        if tag == TEXT_HASH:
+            return self.raw(32).hex()
+        if tag == TEXT_HEX:
+            return self.blob().hex()
+        if tag == TEXT_BASE64:
+            return binascii.b2a_base64(self.blob(), newline=False).decode()
+        if tag == TEXT_SIG:
+            sig = self._take(64)
+            return json.dumps((int.from_bytes(sig[:32], "big"), int.from_bytes(sig[32:], "big")))
+        if tag == TEXT_UTF8:
+            return self.blob().decode()
+        raise ValueError(f"Codec: Unknown text tag {tag}")
+
+
+def _hex_to_bytes(s: str) -> Optional[bytes]:
+    try:
+        raw = bytes.fromhex(s)
+    except ValueError:
+        return None
+    return raw if raw.hex() == s else None
+
+
+def _base64_to_bytes(s: str) -> Optional[bytes]:
+    try:
+        raw = binascii.a2b_base64(s)
+    except (binascii.Error, ValueError):
+        return None
+    return raw if binascii.b2a_base64(raw, newline=False).decode() == s else None
+
+
+def _sig_to_bytes(s: str) -> Optional[bytes]:
+    try:
+        r, s_ = json.loads(s)
+        if type(r) is not int or type(s_) is not int or json.dumps((r, s_)) != s:
+            return None
+        return r.to_bytes(32, "big") + s_.to_bytes(32, "big")
+    except (ValueError, TypeError, AttributeError, OverflowError):
+        return None
+
+
+def pack_frame(kind: int, body: bytes) -> bytes:
+    return _FRAME.pack(MAGIC, CODEC_VERSION, kind, len(body)) + body
+
+
+def unpack_frame(kind: int, payload: bytes) -> memoryview:
+    payload = memoryview(payload)
+    if len(payload) < _FRAME.size:
+        raise ValueError("Codec: Payload too short")
+    magic, version, pkind, length = _FRAME.unpack(payload[: _FRAME.size])
+    if magic != MAGIC:
+        raise ValueError("Codec: Not a binary payload")
+    if version != CODEC_VERSION:
+        raise ValueError(f"Codec: Unsupported codec version {version}")
+    if pkind != kind:
+        raise ValueError(f"Codec: Expected payload kind {kind}, got {pkind}")
+    if len(payload) - _FRAME.size != length:
+        raise ValueError("Codec: Payload length mismatch")
+    return payload[_FRAME.size :]
+
+
+class DataClassBinary(ABC):
+    """Versioned, length prefixed binary encoding
+
+    Subclasses set _CODEC_KIND and implement _encode(Writer) and the _decode(Reader) classmethod.
+    """
+
+    __slots__ = ()
+
+    _CODEC_KIND = 0
+
+    @abstractmethod
+    def _encode(self, w: Writer):
+        """Writes the fields of the object"""
+
+    @classmethod
+    @abstractmethod
+    def _decode(cls, r: Reader):
+        """Reads back an object written by _encode"""
+
+    def to_bytes(self) -> bytes:
+        w = Writer()
+        self._encode(w)
+        return pack_frame(self._CODEC_KIND, w.getvalue())
+
+    @classmethod
+    def from_bytes(cls, payload: bytes):
+        r = Reader(unpack_frame(cls._CODEC_KIND, payload))
+        obj = cls._decode(r)
+        r.done()
+        return obj
+
+    def to_payload(self, fmt: str) -> bytes:
+        """Encodes the object for the wire, either as binary or as compressed json"""
+        if fmt == "binary":
+            return self.to_bytes()
+        return compress(self.to_json())
+
+    @classmethod
+    def from_payload(cls, payload: Union[str, bytes]):
+        """Decodes a binary payload, a compressed json payload or a plain json string"""
+        if is_binary(payload):
+            return cls.from_bytes(payload)
+        return cls.from_json(json_from_payload(payload))
@@ -1,5 +1,6 @@
 import argparse
 import logging
+import os
 import sys
 
 # LOGGING CONSTANTS
@@ -21,6 +22,8 @@ HASH_LENGTH_HEX = 64  # 256 bit string is 64 hexa_dec string
 
 FORK_CHAIN_HEIGHT = 7  # Keep only chains that are within this height of the active chain
 
+BLOCK_UNDO_DEPTH = 100  # Keep undo records for this many blocks below the tip of a chain
+
 MAX_BLOCK_SIZE_KB = 4096
 MAX_SCOINS_POSSIBLE = 100000 * 100
 
@@ -39,6 +42,44 @@ MAXIMUM_TARGET_DIFFICULTY = "0000fffffffffffffffffffffffffffffffffffffffffffffff
 # Cheat Code
 BLOCK_MINING_SPEEDUP = 20
 
+# Blocks with fewer input signatures than this are verified in the calling process
+PARALLEL_VERIFY_MIN_SIGNATURES = 32
+
+# Number of verified signatures remembered so they are not verified again
+SIGNATURE_CACHE_SIZE = 100_000
+
+# Number of recent measurements the miner's rolling stats are taken over
+MINER_STATS_WINDOW = 20
+
+# Seconds between the miner's stats summaries in the log
+MINER_STATS_LOG_INTERVAL = 60
+
+# PEER CONSTANTS
+PEER_CONNECT_TIMEOUT = 5  # seconds
+PEER_READ_TIMEOUT = 30  # seconds
+PEER_RETRIES = 2  # Further attempts after a connection error or timeout
+PEER_RETRY_BACKOFF_SECS = 0.5  # Wait before the first retry, doubled for each one after
+PEER_POOL_SIZE = 4  # Keep-alive connections kept open to each peer
+
+# BROADCAST CONSTANTS
+BROADCAST_WORKERS = 16  # Threads relaying to peers, each peer is sent to by one at a time
+BROADCAST_QUEUE_SIZE = 1000  # Announcements queued for a peer before its oldest are dropped
+BROADCAST_TIMEOUT = (5, 5)  # (connect, read) seconds for a relayed message
+
+# INVENTORY CONSTANTS
+KNOWN_INVENTORY_SIZE = 20000  # Block and transaction hashes remembered as known to each peer
+INV_BATCH_SIZE = 500  # Hashes announced to a peer in one /inv
+MAX_INV_SIZE = 1000  # Hashes looked at in a received /inv, the rest are ignored
+INV_REQUEST_TIMEOUT_SECS = 10  # An item asked for is asked of another peer only after this long
+MAX_INV_ANNOUNCERS = 8  # Peers remembered per requested item to fetch it from if the one asked does not deliver
+
+# MEMPOOL CONSTANTS
+MAX_MEMPOOL_SIZE_KB = 64 * 1024  # Lowest fee rate transactions are evicted past this total size
+MIN_RELAY_FEE_PER_KB = 1  # Transactions paying less are not accepted
+INCREMENTAL_RELAY_FEE_PER_KB = 1  # After an eviction the minimum fee rate is this much above the evicted one
+MEMPOOL_MIN_FEE_HALFLIFE_SECS = 60 * 60 * 12  # The raised minimum fee rate halves this often
+MEMPOOL_EXPIRY_SECS = 60 * 60 * 24  # Transactions not mined by then are dropped
+
 # Define Values from arguments passed
 parser = argparse.ArgumentParser()
 
@@ -46,6 +87,11 @@ parser.add_argument("--version", help="Print Implementation Version", action="st
 parser.add_argument("-p", "--port", type=int, help="Port on which the fullnode should run", default=MINER_SERVER_PORT)
 parser.add_argument("-s", "--seed-server", type=str, help="Url on which the DNS seed server is running", default=SEED_SERVER_URL)
 parser.add_argument("-n", "--new-blockchain", help="Start a new Blockchain from Genesis Block", action="store_true")
+parser.add_argument("--wire-format", choices=["json", "binary"], help="Encoding for blocks and transactions sent to peers", default="json")
+parser.add_argument("--db-format", choices=["json", "binary"], help="Encoding for blocks written to the local DB", default="json")
+parser.add_argument("--verify-workers", type=int, help="Processes used to verify block signatures, 1 to verify serially", default=os.cpu_count() or 1)
+parser.add_argument("--mining-workers", type=int, help="Processes the nonce search is split across", default=os.cpu_count() or 1)
+parser.add_argument("--mempool-size-kb", type=int, help="Largest total size of the transactions in the mempool", default=MAX_MEMPOOL_SIZE_KB)
 group = parser.add_mutually_exclusive_group()
 group.add_argument("-v", "--verbose", action="store_true")
 group.add_argument("-q", "--quiet", action="store_true")
@@ -74,6 +120,19 @@ if args.new_blockchain:
 else:
     NEW_BLOCKCHAIN = False
 
+# Set serialization formats, payloads in either format are always accepted
+WIRE_FORMAT = args.wire_format
+DB_FORMAT = args.db_format
+
+# Set number of signature verification processes
+VERIFY_WORKERS = args.verify_workers
+
+# Set number of mining processes
+MINING_WORKERS = args.mining_workers
+
+# Set mempool size limit
+MAX_MEMPOOL_SIZE_KB = args.mempool_size_kb
+
 # Coinbase Maturity
 COINBASE_MATURITY = 0
 
@@ -89,6 +148,7 @@ GENESIS_BLOCK_SIGNATURE = "4093f844282309feb788feb2d3a81946cbc70478360f0d0fe581e
 # DB CONSTANTS
 BLOCK_DB_LOC = "db/" + str(MINER_SERVER_PORT) + "block.sqlite"
 CHAIN_DB_LOC = "db/" + str(MINER_SERVER_PORT) + "chain.json"
+CHAINSTATE_DB_LOC = "db/" + str(MINER_SERVER_PORT) + "chainstate.sqlite"
 
 # WALLET CONSTANTS
 WALLET_DB_LOC = "wallet/"
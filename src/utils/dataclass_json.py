@@ -5,7 +5,30 @@ from dataclasses import asdict, fields
 from .dataclass_json_core import _Encoder, _decode_dataclass
 
 
+def add_slots(*extra_slots: str):
+    """Recreates a dataclass with __slots__ for its fields and extra_slots, so instances carry no __dict__
+
+    Has to be applied on top of @dataclass, which cannot add slots itself before python 3.10.
+    """
+
+    def decorator(cls):
+        cls_dict = dict(cls.__dict__)
+        field_names = tuple(f.name for f in fields(cls))
+        cls_dict["__slots__"] = field_names + extra_slots
+        for name in field_names:
+            cls_dict.pop(name, None)
+        cls_dict.pop("__dict__", None)
+        cls_dict.pop("__weakref__", None)
+        new_cls = type(cls)(cls.__name__, cls.__bases__, cls_dict)
+        new_cls.__qualname__ = cls.__qualname__
+        return new_cls
+
+    return decorator
+
+
 class DataClassJson:
+    __slots__ = ()
+
     def to_json(
         self,
         *,
@@ -43,6 +66,10 @@ class DataClassJson:
             init_kwargs = ChainMap(init_kwargs, {field.name: None for field in fields(cls) if field.name not in init_kwargs})
         return _decode_dataclass(cls, init_kwargs)
 
+    @classmethod
+    def from_dict(cls, kvs):
+        return _decode_dataclass(cls, kvs)
+
     @classmethod
     def from_json_array(cls, kvss, encoding=None, parse_float=None, parse_int=None, parse_constant=None):
         init_kwargs_array = json.loads(
@@ -1,7 +1,7 @@
 import json
 import sys
 from dataclasses import fields, is_dataclass
-from typing import Collection, Optional
+from typing import Any, Callable, Collection, Dict, Mapping, Optional, Union
 
 
 def _get_type_origin(type_):
@@ -22,28 +22,6 @@ def _get_type_origin(type_):
     return origin
 
 
-def _get_type_cons(type_):
-    """More spaghetti logic for 3.6 vs. 3.7"""
-    if sys.version_info.minor == 6:
-        try:
-            cons = type_.__extra__
-        except AttributeError:
-            try:
-                cons = type.__origin__
-            except AttributeError:
-                cons = type_
-            else:
-                cons = type_ if cons is None else cons
-        else:
-            try:
-                cons = type.__origin__ if cons is None else cons
-            except AttributeError:
-                cons = type_
-    else:
-        cons = type_.__origin__
-    return cons
-
-
 class _Encoder(json.JSONEncoder):
     def default(self, o):
         if _isinstance_safe(o, Collection):
@@ -51,62 +29,84 @@ class _Encoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, o)
 
 
+# Compiled decoders, one per dataclass
+_DECODERS: Dict[type, Callable[[Any], Any]] = {}
+
+
 def _decode_dataclass(cls, kvs):
-    init_kwargs = {}
-    for field in fields(cls):
-        field_value = kvs[field.name]
-        if is_dataclass(field.type):
-            init_kwargs[field.name] = _decode_dataclass(field.type, field_value)
-        elif _is_supported_generic(field.type) and field.type != str:
-            init_kwargs[field.name] = _decode_generic(field.type, field_value)
-        else:
-            init_kwargs[field.name] = field_value
-    return cls(**init_kwargs)
+    return _get_decoder(cls)(kvs)
 
 
-def _is_supported_generic(type_):
+def _get_decoder(cls):
     try:
-        # __origin__ exists in 3.7 on user defined generics
-        is_collection = _issubclass_safe(type_.__origin__, Collection)
-    except AttributeError:
-        return False
-    is_optional = _issubclass_safe(type_, Optional) or _hasargs(type_, type(None))
-    return is_collection or is_optional
-
-
-def _decode_generic(type_, value):
-    if value is None:
-        res = value
-    elif _issubclass_safe(_get_type_origin(type_), Collection):
-        # this is a tricky situation where we need to check both the annotated
-        # type info (which is usually a type from `typing`) and check the
-        # value's type directly using `type()`.
-        #
-        # if the type_arg is a generic we can use the annotated type, but if the
-        # type_arg is a typevar we need to extract the reified type information
-        # hence the check of `is_dataclass(value)`
-        type_arg = type_.__args__[0]
-        if is_dataclass(type_arg) or is_dataclass(value):
-            xs = (_decode_dataclass(type_arg, v) for v in value)
-        elif _is_supported_generic(type_arg):
-            xs = (_decode_generic(type_arg, v) for v in value)
-        else:
-            xs = value
-        # get the constructor if using corresponding generic type in `typing`
-        # otherwise fallback on the type returned by
-        try:
-            res = _get_type_cons(type_)(xs)
-        except TypeError:
-            res = type_(xs)
-    else:  # Optional
-        type_arg = type_.__args__[0]
-        if is_dataclass(type_arg) or is_dataclass(value):
-            res = _decode_dataclass(type_arg, value)
-        elif _is_supported_generic(type_arg):
-            res = _decode_generic(type_arg, value)
-        else:
-            res = value
-    return res
+        return _DECODERS[cls]
+    except KeyError:
+        decoder = _DECODERS[cls] = _compile_decoder(cls)
+        return decoder
+
+
+def _compile_decoder(cls):
+    """Resolves the field types of cls once and returns a function that builds
+    a fully typed instance of cls from a parsed json dict.
+
+    Decoders are compiled on the first decode of each class instead of when
+    the class is created, as @dataclass only runs after the class body."""
+    converters = [(field.name, _compile_converter(field.type)) for field in fields(cls)]
+    plain = tuple(name for name, conv in converters if conv is None)
+    typed = tuple((name, conv) for name, conv in converters if conv is not None)
+
+    def decode(kvs):
+        init_kwargs = {name: kvs[name] for name in plain}
+        for name, conv in typed:
+            init_kwargs[name] = conv(kvs[name])
+        return cls(**init_kwargs)
+
+    return decode
+
+
+def _compile_converter(type_) -> Optional[Callable[[Any], Any]]:
+    """Returns a function converting a parsed json value to type_,
+    or None when the json value can be used as it is"""
+    if is_dataclass(type_):
+        return _get_decoder(type_)
+
+    origin = _get_type_origin(type_)
+    args = getattr(type_, "__args__", None) or ()
+
+    if origin is Union:
+        # Optional[T] is Union[T, None]
+        type_args = [arg for arg in args if arg is not type(None)]
+        if len(type_args) != 1:
+            return None
+        conv = _compile_converter(type_args[0])
+        if conv is None:
+            return None
+        return lambda value: None if value is None else conv(value)
+
+    if _issubclass_safe(origin, Mapping) and len(args) == 2:
+        # json object keys are always strings
+        key_conv = int if args[0] is int else _compile_converter(args[0])
+        value_conv = _compile_converter(args[1])
+        if key_conv is None and value_conv is None:
+            return None
+        key_conv = key_conv or _identity
+        value_conv = value_conv or _identity
+        return lambda value: None if value is None else {key_conv(k): value_conv(v) for k, v in value.items()}
+
+    if _issubclass_safe(origin, Collection) and not _issubclass_safe(origin, str) and args:
+        cons = origin if origin in (list, set, frozenset, tuple) else list
+        item_conv = _compile_converter(args[0])
+        if item_conv is None:
+            if cons is list:
+                return None
+            return lambda value: None if value is None else cons(value)
+        return lambda value: None if value is None else cons(item_conv(v) for v in value)
+
+    return None
+
+
+def _identity(value):
+    return value
 
 
 def _issubclass_safe(cls, classinfo):
@@ -125,12 +125,3 @@ def _isinstance_safe(o, t):
         return False
     else:
         return result
-
-
-def _hasargs(type_, *args):
-    try:
-        res = all(arg in type_.__args__ for arg in args)
-    except AttributeError:
-        return False
-    else:
-        return res
@@ -0,0 +1,126 @@
+from binascii import hexlify
+from hashlib import sha256
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+
+from . import constants as consts
+
+if TYPE_CHECKING:
+    import os
+    import sys
+
+    sys.path.append(os.path.split(sys.path[0])[0])
+    from src.core import Transaction  # noqa
+
+# Root of a tree without leaves
+EMPTY_ROOT_HEX = "F" * consts.HASH_LENGTH_HEX
+
+# (sibling digest, whether the sibling is on the right) for each level, leaf level first
+MerkleProof = List[Tuple[bytes, bool]]
+
+
+def combine(left: bytes, right: bytes) -> bytes:
+    """The parent of two nodes, a double sha256 over their concatenated hex digests as merkle_hash always did"""
+    return sha256(sha256(hexlify(left + right)).digest()).digest()
+
+
+class MerkleTree:
+    """Merkle tree over raw 32 byte digests that keeps all its levels
+
+    A level with an odd number of nodes pairs its last node with itself. Appending or replacing a leaf
+    only rehashes the path from that leaf to the root, and proofs are read off the stored levels.
+    """
+
+    def __init__(self, leaves: Iterable[bytes] = ()):
+        self.levels: List[List[bytes]] = [list(leaves)]
+        level = self.levels[0]
+        while len(level) > 1:
+            level = [combine(level[i], level[i + 1] if i + 1 < len(level) else level[i]) for i in range(0, len(level), 2)]
+            self.levels.append(level)
+
+    @classmethod
+    def from_transactions(cls, transactions: List["Transaction"]) -> "MerkleTree":
+        return cls(bytes.fromhex(t.hash) for t in transactions)
+
+    def __len__(self) -> int:
+        return len(self.levels[0])
+
+    @property
+    def root(self) -> Optional[bytes]:
+        return self.levels[-1][0] if self.levels[0] else None
+
+    def root_hex(self) -> str:
+        return self.root.hex() if self.levels[0] else EMPTY_ROOT_HEX
+
+    def append(self, leaf: bytes):
+        self.levels[0].append(leaf)
+        self._update_path(len(self.levels[0]) - 1)
+
+    def extend(self, leaves: Iterable[bytes]):
+        """Appends many leaves, hashing each new node once instead of a path per leaf"""
+        start = len(self.levels[0])
+        self.levels[0].extend(leaves)
+        self._rehash_from(start)
+
+    def truncate(self, size: int):
+        """Drops the leaves from size on, only the new right edge of the tree is rehashed"""
+        del self.levels[0][size:]
+        self._rehash_from(max(size - 1, 0))
+
+    def _rehash_from(self, index: int):
+        """Recomputes every node to the right of leaf index's path, up to the root"""
+        height = 0
+        while len(self.levels[height]) > 1:
+            level = self.levels[height]
+            first = index & ~1
+            parents = [combine(level[i], level[i + 1] if i + 1 < len(level) else level[i]) for i in range(first, len(level), 2)]
+            if height + 1 == len(self.levels):
+                self.levels.append([])
+            upper = self.levels[height + 1]
+            del upper[first // 2 :]
+            upper.extend(parents)
+            index = first // 2
+            height += 1
+        del self.levels[height + 1 :]
+
+    def copy(self) -> "MerkleTree":
+        tree = MerkleTree()
+        tree.levels = [list(level) for level in self.levels]
+        return tree
+
+    def update(self, index: int, leaf: bytes):
+        self.levels[0][index] = leaf
+        self._update_path(index)
+
+    def _update_path(self, index: int):
+        height = 0
+        while len(self.levels[height]) > 1:
+            level = self.levels[height]
+            left = index & ~1
+            parent = combine(level[left], level[left + 1] if left + 1 < len(level) else level[left])
+            index >>= 1
+            if height + 1 == len(self.levels):
+                self.levels.append([])
+            upper = self.levels[height + 1]
+            if index == len(upper):
+                upper.append(parent)
+            else:
+                upper[index] = parent
+            height += 1
+
+    def proof(self, index: int) -> MerkleProof:
+        """Returns the siblings needed to get from leaf index to the root"""
+        if not 0 <= index < len(self.levels[0]):
+            raise IndexError("Merkle: Leaf index out of range")
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            proof.append((level[sibling] if sibling < len(level) else level[index], index % 2 == 0))
+            index >>= 1
+        return proof
+
+    @staticmethod
+    def verify_proof(leaf: bytes, proof: MerkleProof, root: bytes) -> bool:
+        node = leaf
+        for sibling, is_right in proof:
+            node = combine(node, sibling) if is_right else combine(sibling, node)
+        return node == root
@@ -1,10 +1,19 @@
 import os
-from typing import TYPE_CHECKING
+import sqlite3
+from contextlib import closing
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple, Union
 
 from sqlitedict import SqliteDict
 
-from .constants import BLOCK_DB_LOC, CHAIN_DB_LOC, WALLET_DB_LOC, NEW_BLOCKCHAIN
-from .utils import dhash
+from .constants import (
+    BLOCK_DB_LOC,
+    BLOCK_UNDO_DEPTH,
+    CHAIN_DB_LOC,
+    CHAINSTATE_DB_LOC,
+    DB_FORMAT,
+    WALLET_DB_LOC,
+    NEW_BLOCKCHAIN,
+)
 from .encode_keys import encode_public_key
 
 from fastecdsa.keys import export_key, import_key
@@ -23,10 +32,11 @@ if TYPE_CHECKING:
 WALLET_DB = None
 
 if NEW_BLOCKCHAIN:
-    try:
-        os.remove(BLOCK_DB_LOC)
-    except OSError:
-        pass
+    for loc in (BLOCK_DB_LOC, CHAINSTATE_DB_LOC):
+        try:
+            os.remove(loc)
+        except OSError:
+            pass
 
 
 # WALLET FUNCTIONS
@@ -47,15 +57,16 @@ def add_wallet_to_db(port: str, wallet: "Wallet"):
 
 
 # BLOCK FUNCTIONS
-def get_block_from_db(header_hash: str) -> str:
+def get_block_from_db(header_hash: str) -> Union[str, bytes]:
     with SqliteDict(BLOCK_DB_LOC, autocommit=False) as db:
         return db.get(header_hash, None)
 
 
 def add_block_to_db(block: "Block"):
     with SqliteDict(BLOCK_DB_LOC, autocommit=False) as db:
-        db[dhash(block.header)] = block.to_json()
-        db.commit(blocking=False)
+        db[block.header.hash] = block.to_bytes() if DB_FORMAT == "binary" else block.to_json()
+        # Durable before the chainstate can point at it
+        db.commit()
 
 
 def check_block_in_db(header_hash: str) -> bool:
@@ -74,7 +85,7 @@ def remove_block_from_db(header_hash: str):
 # Active Chain functions
 def write_header_list_to_db(header_list: list):
     with open(CHAIN_DB_LOC, "w") as file:
-        headers = list(map(dhash, header_list))
+        headers = [header.hash for header in header_list]
         file.write(dumps(headers))
 
 
@@ -84,3 +95,85 @@ def read_header_list_from_db():
         if data:
             return loads(data)
     return None
+
+
+# Chainstate functions
+# The UTXO set and headers of the active chain, so that a restart does not replay every block.
+# Every write is a single sqlite transaction tagged with the tip hash, so the DB is always at some block's tip.
+
+# (txid, vout) of a spent output
+SpentRow = Tuple[bytes, int]
+# (txid, vout, amount, address, height, is_coinbase) of an unspent output
+UtxoRow = Tuple[bytes, int, Any, str, int, bool]
+# (height, header hash, header bytes)
+HeaderRow = Tuple[int, str, bytes]
+# (height, header hash, undo record bytes)
+UndoRow = Tuple[int, str, bytes]
+
+# amount has no declared type so sqlite keeps ints and floats as they are
+CHAINSTATE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS utxo (txid BLOB, vout INTEGER, amount, address TEXT, height INTEGER, "
+    "is_coinbase INTEGER, PRIMARY KEY (txid, vout))",
+    "CREATE TABLE IF NOT EXISTS headers (height INTEGER PRIMARY KEY, hash TEXT, header BLOB)",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)",
+    "CREATE TABLE IF NOT EXISTS undo (height INTEGER PRIMARY KEY, hash TEXT, undo BLOB)",
+)
+
+
+def open_chainstate_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(CHAINSTATE_DB_LOC)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for stmt in CHAINSTATE_SCHEMA:
+        conn.execute(stmt)
+    return conn
+
+
+def write_chainstate(
+    meta: Dict[str, Any],
+    headers: Iterable[HeaderRow],
+    spent: Iterable[SpentRow],
+    created: Iterable[UtxoRow],
+    undo: Iterable[UndoRow] = (),
+    rewrite: bool = False,
+):
+    """Atomically applies UTXO and header changes and moves the tip in meta
+
+    Arguments:
+        meta {Dict[str, Any]} -- tip, length, target_difficulty and total_scoins of the chain
+        headers {Iterable[HeaderRow]} -- headers to add, replacing any at the same height
+        spent {Iterable[SpentRow]} -- outputs to remove
+        created {Iterable[UtxoRow]} -- outputs to add
+        undo {Iterable[UndoRow]} -- undo records of the added blocks, only the last BLOCK_UNDO_DEPTH are kept
+        rewrite {bool} -- drop everything stored before, for when the active chain is replaced
+    """
+    with closing(open_chainstate_db()) as conn:
+        with conn:
+            if rewrite:
+                conn.execute("DELETE FROM utxo")
+                conn.execute("DELETE FROM headers")
+                conn.execute("DELETE FROM undo")
+            conn.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?)", headers)
+            conn.execute("DELETE FROM headers WHERE height >= ?", (meta["length"],))
+            conn.executemany("DELETE FROM utxo WHERE txid = ? AND vout = ?", spent)
+            conn.executemany("INSERT OR REPLACE INTO utxo VALUES (?, ?, ?, ?, ?, ?)", created)
+            conn.executemany("INSERT OR REPLACE INTO undo VALUES (?, ?, ?)", undo)
+            conn.execute(
+                "DELETE FROM undo WHERE height >= ? OR height < ?",
+                (meta["length"], meta["length"] - BLOCK_UNDO_DEPTH),
+            )
+            conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", meta.items())
+
+
+def read_chainstate() -> Optional[Tuple[Dict[str, Any], List[bytes], List[UtxoRow], List[UndoRow]]]:
+    """Returns the meta, the headers ordered by height, the UTXO rows and the undo rows,
+    or None if nothing was saved"""
+    if not os.path.exists(CHAINSTATE_DB_LOC):
+        return None
+    with closing(open_chainstate_db()) as conn:
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        if "tip" not in meta:
+            return None
+        headers = [row[0] for row in conn.execute("SELECT header FROM headers ORDER BY height")]
+        utxo = conn.execute("SELECT txid, vout, amount, address, height, is_coinbase FROM utxo").fetchall()
+        undo = conn.execute("SELECT height, hash, undo FROM undo").fetchall()
+    return meta, headers, utxo, undo
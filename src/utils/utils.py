@@ -5,7 +5,7 @@ from base64 import b85decode, b85encode
 from functools import wraps
 from typing import TYPE_CHECKING, List, Union
 
-from . import constants as consts
+from .merkle import EMPTY_ROOT_HEX, MerkleTree
 
 if TYPE_CHECKING:
     import os
@@ -33,24 +33,9 @@ def get_time_difference_from_now_secs(timestamp: int) -> int:
 
 def merkle_hash(transactions: List["Transaction"]) -> str:
     """ Computes and returns the merkle tree root for a list of transactions """
-    if transactions is None or len(transactions) == 0:
-        return "F" * consts.HASH_LENGTH_HEX
-    if len(transactions) == 1:
-        return dhash(transactions[0])
-    if len(transactions) % 2 != 0:
-        transactions = transactions + [transactions[-1]]
-    transactions_hash = list(map(dhash, transactions))
-
-    def recursive_merkle_hash(t: List[str]) -> str:
-        if len(t) == 1:
-            return t[0]
-        t_child = []
-        for i in range(0, len(t), 2):
-            new_hash = dhash(t[i] + t[i + 1])
-            t_child.append(new_hash)
-        return recursive_merkle_hash(t_child)
-
-    return recursive_merkle_hash(transactions_hash)
+    if transactions is None:
+        return EMPTY_ROOT_HEX
+    return MerkleTree.from_transactions(transactions).root_hex()
 
 
 def dhash(s: Union[str, "Transaction", "BlockHeader"]) -> str:
@@ -0,0 +1,135 @@
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import utils.constants as consts
+from utils.logger import logger
+from wallet import Wallet
+
+# (signed message, signature, public key) of a transaction input
+SigCheck = Tuple[str, str, str]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = Lock()
+
+
+class SignatureCache:
+    """ Bounded LRU set of signatures that verified, so a transaction seen in the mempool is not verified again in a block """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[bytes, None]" = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(check: SigCheck) -> bytes:
+        # One digest over sighash, signature and key keeps entries small
+        message, sig, public_key = check
+        return hashlib.sha256("\n".join((message, sig, public_key)).encode()).digest()
+
+    def contains(self, check: SigCheck) -> bool:
+        key = self.key(check)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, checks: List[SigCheck]):
+        keys = [self.key(check) for check in checks]
+        with self.lock:
+            for key in keys:
+                self.entries[key] = None
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+SIGNATURE_CACHE = SignatureCache(consts.SIGNATURE_CACHE_SIZE)
+
+
+def _verify(check: SigCheck) -> bool:
+    message, sig, public_key = check
+    try:
+        return Wallet.verify(message, sig, public_key)
+    except Exception:
+        # A malformed signature or key just fails verification
+        return False
+
+
+def verify_one(check: SigCheck) -> bool:
+    if SIGNATURE_CACHE.contains(check):
+        return True
+    if _verify(check):
+        SIGNATURE_CACHE.add([check])
+        return True
+    return False
+
+
+def verify_serial(checks: List[SigCheck]) -> bool:
+    return all(_verify(check) for check in checks)
+
+
+def get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    with _pool_lock:
+        if _pool is None and consts.VERIFY_WORKERS > 1:
+            _pool = ProcessPoolExecutor(max_workers=consts.VERIFY_WORKERS)
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+def verify_batch(checks: List[SigCheck]) -> bool:
+    """Verifies a batch of input signatures, across VERIFY_WORKERS processes when the batch is large enough
+
+    Signatures already in the cache are skipped and the rest are cached if they all verify.
+    Falls back to verifying serially if the pool cannot be used.
+
+    Arguments:
+        checks {List[SigCheck]} -- Every (message, sig, public key) to verify
+
+    Returns:
+        bool -- True if every signature is valid
+    """
+    checks = [check for check in checks if not SIGNATURE_CACHE.contains(check)]
+    if _verify_uncached(checks):
+        SIGNATURE_CACHE.add(checks)
+        return True
+    return False
+
+
+def _verify_uncached(checks: List[SigCheck]) -> bool:
+    if len(checks) < consts.PARALLEL_VERIFY_MIN_SIGNATURES:
+        return verify_serial(checks)
+    pool = get_pool()
+    if pool is None:
+        return verify_serial(checks)
+
+    # A few chunks per worker keeps them busy without paying the IPC cost per signature
+    n_chunks = consts.VERIFY_WORKERS * 4
+    size = -(-len(checks) // n_chunks)
+    chunks = [checks[i : i + size] for i in range(0, len(checks), size)]
+    try:
+        return all(pool.map(verify_serial, chunks))
+    except (BrokenProcessPool, OSError) as e:
+        logger.error("Verifier: Process pool failed, verifying serially " + str(e))
+        shutdown_pool()
+        return verify_serial(checks)